@@ -0,0 +1,322 @@
+import json
+import sqlite3
+import threading
+
+# Storage backends, each one covers the operations main.py uses on the users collection and the config/settings document.
+# The methods are blocking, Storage in storage.py runs them off the event loop when the backend says it needs to.
+# Every method takes a namespace first, one per server. None is the original single server layout (config/settings and users).
+
+class Increment: # backend neutral increment, used in the changes dicts instead of firestore.Increment
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f"Increment({self.value})"
+
+class Delete: # backend neutral field removal, used in the changes dicts instead of firestore.DELETE_FIELD
+    def __repr__(self):
+        return "Delete()"
+
+def apply_changes(doc, changes): # applies an update() style changes dict to a plain dict, increments included
+    for key, value in changes.items():
+        if isinstance(value, Increment):
+            doc[key] = doc.get(key, 0) + value.value
+        elif isinstance(value, Delete):
+            doc.pop(key, None)
+        else:
+            doc[key] = value
+    return doc
+
+def expired(doc, cutoff): # same rule as the firestore query, a streak above 0 and a last worksheet before the cutoff
+    return doc.get('streak', 0) > 0 and doc.get('last_worksheet_date', "9999-12-31") < cutoff
+
+
+class FirestoreBackend:
+    blocking = True # every call is a network round trip
+
+    def __init__(self, creds_string):
+        import firebase_admin # imported here so the other backends work without firebase installed
+        from firebase_admin import credentials, firestore
+        self._firestore = firestore
+        if not firebase_admin._apps: # initialize_app fails if it was already called
+            firebase_admin.initialize_app(credentials.Certificate(json.loads(creds_string)))
+        self.db = firestore.client()
+
+    def get_user(self, namespace, user_id):
+        doc = self._users(namespace).document(str(user_id)).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set_user(self, namespace, user_id, data, merge=False):
+        self._users(namespace).document(str(user_id)).set(self._convert(data), merge=merge)
+
+    def update_user(self, namespace, user_id, changes): # merges, so it also works on a missing document
+        self._users(namespace).document(str(user_id)).set(self._convert(changes), merge=True)
+
+    def scan_users(self, namespace):
+        return [{'id': doc.id, **doc.to_dict()} for doc in self._users(namespace).get()]
+
+    def expiring_streaks(self, namespace, cutoff, page_size, cursor=None): # needs the composite index in firestore.indexes.json
+        query = (self._users(namespace)
+                 .where(filter=self._firestore.FieldFilter('last_worksheet_date', '<', cutoff))
+                 .where(filter=self._firestore.FieldFilter('streak', '>', 0))
+                 .order_by('last_worksheet_date')
+                 .order_by('streak'))
+        if cursor is not None:
+            query = query.start_after(cursor)
+        page = query.limit(page_size).get()
+        return [{'id': doc.id, **doc.to_dict()} for doc in page], (page[-1] if page else None) # the last snapshot is the cursor for the next page
+
+    def period_scores(self, namespace, field): # users that have the period counter, highest first, uses firestore's automatic single field index
+        query = self._users(namespace).order_by(field, direction=self._firestore.Query.DESCENDING)
+        return [{'id': doc.id, **doc.to_dict()} for doc in query.stream()]
+
+    def write_users(self, namespace, writes, merge=False, marker=None): # one batch, at most 500 writes counting the marker
+        batch = self.db.batch()
+        users = self._users(namespace)
+        for user_id, data in writes:
+            doc_ref = users.document(str(user_id))
+            if merge: # set with merge also creates missing documents, so one bad id can't fail the whole batch
+                batch.set(doc_ref, self._convert(data), merge=True)
+            else:
+                batch.update(doc_ref, self._convert(data))
+        if marker is not None: # (journal id, batch id), committed atomically with the writes so a retry can tell whether they landed
+            journal_id, batch_id = marker
+            batch.set(self.db.collection('flushes').document(journal_id), {'batch': batch_id})
+        batch.commit()
+
+    def last_flush(self, journal_id): # id of the last batch the journal committed, one document per journal
+        doc = self.db.collection('flushes').document(journal_id).get()
+        return doc.to_dict().get('batch') if doc.exists else None
+
+    def get_config(self, namespace):
+        doc = self._config(namespace).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set_config(self, namespace, data, merge=True):
+        self._config(namespace).set(data, merge=merge)
+
+    def watch_configs(self, callback, namespaced): # calls callback(namespace, settings dict or None) from a firestore thread on every change, returns the watches
+        def on_settings(docs, changes, read_time):
+            callback(None, docs[0].to_dict() if docs and docs[0].exists else None)
+        def on_guilds(docs, changes, read_time): # routed by document id, so one stream covers every server
+            for change in changes:
+                callback(change.document.id, None if change.type.name == "REMOVED" else change.document.to_dict())
+        watches = [self._config(None).on_snapshot(on_settings)]
+        if namespaced: # in single server mode only the main settings document is used
+            watches.append(self.db.collection('guilds').on_snapshot(on_guilds))
+        return watches
+
+    def get_history(self, namespace, period):
+        doc = self._history(namespace).document(period).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set_history(self, namespace, period, data):
+        self._history(namespace).document(period).set(data)
+
+    def _users(self, namespace): # guilds/{id}/users, the composite index applies to it too since it's scoped by collection id
+        if namespace is None:
+            return self.db.collection('users')
+        return self.db.collection('guilds').document(namespace).collection('users')
+
+    def _config(self, namespace): # a server's settings are the fields of its guilds/{id} document
+        if namespace is None:
+            return self.db.collection('config').document('settings')
+        return self.db.collection('guilds').document(namespace)
+
+    def _history(self, namespace): # one document per closed week or month
+        if namespace is None:
+            return self.db.collection('history')
+        return self.db.collection('guilds').document(namespace).collection('history')
+
+    def _convert(self, data):
+        converted = {}
+        for key, value in data.items():
+            if isinstance(value, Increment):
+                value = self._firestore.Increment(value.value)
+            elif isinstance(value, Delete):
+                value = self._firestore.DELETE_FIELD
+            converted[key] = value
+        return converted
+
+
+class MemoryBackend: # keeps everything in dicts, for tests, benchmarks and trying the bot out offline
+    blocking = False # nothing to wait on, so Storage calls it directly
+
+    def __init__(self):
+        self.users = {} # namespace -> user id -> document
+        self.config = {} # namespace -> settings
+        self.history = {} # namespace -> period -> snapshot
+        self.flushes = {} # journal id -> last committed batch id
+        self._watchers = []
+
+    def get_user(self, namespace, user_id):
+        doc = self.users.get(namespace, {}).get(str(user_id))
+        return dict(doc) if doc is not None else None
+
+    def set_user(self, namespace, user_id, data, merge=False):
+        users = self.users.setdefault(namespace, {})
+        if merge:
+            apply_changes(users.setdefault(str(user_id), {}), data)
+        else:
+            users[str(user_id)] = apply_changes({}, data)
+
+    def update_user(self, namespace, user_id, changes):
+        apply_changes(self.users.setdefault(namespace, {}).setdefault(str(user_id), {}), changes)
+
+    def scan_users(self, namespace):
+        return [{'id': user_id, **doc} for user_id, doc in self.users.get(namespace, {}).items()]
+
+    def expiring_streaks(self, namespace, cutoff, page_size, cursor=None): # the cursor is the last returned user id
+        users = self.users.get(namespace, {})
+        ids = sorted(user_id for user_id, doc in users.items() if expired(doc, cutoff) and (cursor is None or user_id > cursor))[:page_size]
+        return [{'id': user_id, **users[user_id]} for user_id in ids], (ids[-1] if ids else None)
+
+    def period_scores(self, namespace, field):
+        users = self.users.get(namespace, {})
+        ids = sorted((user_id for user_id, doc in users.items() if field in doc), key=lambda user_id: (-users[user_id][field], user_id))
+        return [{'id': user_id, **users[user_id]} for user_id in ids]
+
+    def write_users(self, namespace, writes, merge=False, marker=None):
+        for user_id, data in writes:
+            self.update_user(namespace, user_id, data)
+        if marker is not None:
+            self.flushes[marker[0]] = marker[1]
+
+    def last_flush(self, journal_id):
+        return self.flushes.get(journal_id)
+
+    def get_config(self, namespace):
+        config = self.config.get(namespace)
+        return dict(config) if config is not None else None
+
+    def set_config(self, namespace, data, merge=True):
+        if merge and namespace in self.config:
+            self.config[namespace].update(data)
+        else:
+            self.config[namespace] = dict(data)
+        for callback in self._watchers:
+            callback(namespace, dict(self.config[namespace]))
+
+    def watch_configs(self, callback, namespaced): # all writes go through this object, so watching is just calling back on set_config
+        self._watchers.append(callback)
+        return [callback]
+
+    def get_history(self, namespace, period):
+        snapshot = self.history.get(namespace, {}).get(period)
+        return dict(snapshot) if snapshot is not None else None
+
+    def set_history(self, namespace, period, data):
+        self.history.setdefault(namespace, {})[period] = dict(data)
+
+
+class SQLiteBackend: # local file, for small deployments that don't want any network round trips
+    blocking = True # disk writes, so it still runs on the storage threads
+
+    def __init__(self, path):
+        self._lock = threading.Lock() # one connection shared by the storage threads
+        self._watchers = []
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(users)")]
+        if columns and "guild" not in columns: # files from before servers had their own namespace, their data becomes the '' namespace
+            self._conn.execute("ALTER TABLE users RENAME TO users_single")
+            self._conn.execute("ALTER TABLE config RENAME TO config_single")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS users (guild TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (guild, id))")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS config (guild TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS history (guild TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (guild, id))")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS flushes (id TEXT PRIMARY KEY, batch TEXT NOT NULL)")
+        if columns and "guild" not in columns:
+            self._conn.execute("INSERT INTO users (guild, id, data) SELECT '', id, data FROM users_single")
+            self._conn.execute("INSERT INTO config (guild, data) SELECT '', data FROM config_single WHERE id = 'settings'")
+            self._conn.execute("DROP TABLE users_single")
+            self._conn.execute("DROP TABLE config_single")
+        self._conn.commit()
+
+    def get_user(self, namespace, user_id):
+        with self._lock:
+            return self._get_user(namespace or "", str(user_id))
+
+    def set_user(self, namespace, user_id, data, merge=False):
+        with self._lock, self._conn:
+            doc = self._get_user(namespace or "", str(user_id)) if merge else None
+            self._put_user(namespace or "", str(user_id), apply_changes(doc or {}, data))
+
+    def update_user(self, namespace, user_id, changes):
+        self.set_user(namespace, user_id, changes, merge=True)
+
+    def scan_users(self, namespace):
+        with self._lock:
+            rows = self._conn.execute("SELECT id, data FROM users WHERE guild = ?", (namespace or "",)).fetchall()
+        return [{'id': user_id, **json.loads(data)} for user_id, data in rows]
+
+    def expiring_streaks(self, namespace, cutoff, page_size, cursor=None): # the cursor is the last returned user id
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, data FROM users WHERE guild = ? AND json_extract(data, '$.streak') > 0 AND json_extract(data, '$.last_worksheet_date') < ? "
+                "AND id > ? ORDER BY id LIMIT ?", (namespace or "", cutoff, cursor or "", page_size)).fetchall()
+        docs = [{'id': user_id, **json.loads(data)} for user_id, data in rows]
+        return docs, (docs[-1]['id'] if docs else None)
+
+    def period_scores(self, namespace, field):
+        path = f"$.{field}"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, data FROM users WHERE guild = ? AND json_extract(data, ?) IS NOT NULL ORDER BY json_extract(data, ?) DESC, id",
+                (namespace or "", path, path)).fetchall()
+        return [{'id': user_id, **json.loads(data)} for user_id, data in rows]
+
+    def write_users(self, namespace, writes, merge=False, marker=None): # all the writes go in one transaction, like a firestore batch
+        with self._lock, self._conn:
+            for user_id, data in writes:
+                self._put_user(namespace or "", str(user_id), apply_changes(self._get_user(namespace or "", str(user_id)) or {}, data))
+            if marker is not None:
+                self._conn.execute("INSERT OR REPLACE INTO flushes (id, batch) VALUES (?, ?)", marker)
+
+    def last_flush(self, journal_id):
+        with self._lock:
+            row = self._conn.execute("SELECT batch FROM flushes WHERE id = ?", (journal_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_config(self, namespace):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM config WHERE guild = ?", (namespace or "",)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_config(self, namespace, data, merge=True):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT data FROM config WHERE guild = ?", (namespace or "",)).fetchone()
+            current = json.loads(row[0]) if row and merge else {}
+            current.update(data)
+            self._conn.execute("INSERT OR REPLACE INTO config (guild, data) VALUES (?, ?)", (namespace or "", json.dumps(current)))
+        for callback in self._watchers:
+            callback(namespace, dict(current))
+
+    def watch_configs(self, callback, namespaced): # only sees the bot's own writes, the file isn't watched for outside edits
+        self._watchers.append(callback)
+        return [callback]
+
+    def get_history(self, namespace, period):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM history WHERE guild = ? AND id = ?", (namespace or "", period)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_history(self, namespace, period, data):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO history (guild, id, data) VALUES (?, ?, ?)", (namespace or "", period, json.dumps(data)))
+
+    def _get_user(self, guild, user_id):
+        row = self._conn.execute("SELECT data FROM users WHERE guild = ? AND id = ?", (guild, user_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put_user(self, guild, user_id, doc):
+        self._conn.execute("INSERT OR REPLACE INTO users (guild, id, data) VALUES (?, ?, ?)", (guild, user_id, json.dumps(doc)))
+
+
+def create_backend(name, firebase_creds=None, sqlite_path="bot.db"): # picks the backend from the STORAGE_BACKEND setting
+    if name == "firestore":
+        return FirestoreBackend(firebase_creds)
+    if name == "sqlite":
+        return SQLiteBackend(sqlite_path)
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown storage backend: {name}")
@@ -0,0 +1,29 @@
+import asyncio
+
+# Helpers for /backfill, which replays channel history through the scoring functions in main.py
+
+async def prefetch(iterator, size): # reads up to size items ahead of the consumer, so the next history page is fetched while the current one is scored
+    queue = asyncio.Queue(maxsize=size) # bounded, so a slow consumer never holds more than size messages in memory
+    done = object()
+    error = None
+
+    async def fill():
+        nonlocal error
+        try:
+            async for item in iterator:
+                await queue.put(item)
+        except Exception as e: # raised again on the consumer's side
+            error = e
+        await queue.put(done)
+
+    task = asyncio.create_task(fill())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+        if error is not None:
+            raise error
+    finally:
+        task.cancel() # the consumer stopped early, stop fetching pages nobody will read
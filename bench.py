@@ -0,0 +1,159 @@
+# Synthetic load benchmark for on_message, check_user and the scheduled jobs
+# Runs the real handlers from main.py against the in memory storage backend with fake discord messages, nothing is sent to discord
+# usage: python bench.py --messages 5000 --users 300 --save baseline.json
+#        python bench.py --messages 5000 --users 300 --compare baseline.json
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import date, timedelta
+import fakes
+from fakes import CHANNELS, FakeAuthor, FakeAttachment, FakeChannel, FakeMessage, fixed_date
+
+bench_dir = fakes.prepare("memory", "bench-", LOG_QUEUE_SIZE=1000000) # before main is imported
+
+import main
+
+class CountingBackend: # wraps the real backend and counts reads and written documents
+    READS = {"get_user", "scan_users", "expiring_streaks", "get_config"}
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.blocking = backend.blocking
+        self.reads = 0
+        self.writes = 0
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)
+        def counted(*args, **kwargs):
+            if name in self.READS:
+                self.reads += 1
+            elif name == "write_users":
+                self.writes += len(args[1]) # args[0] is the namespace
+            else:
+                self.writes += 1
+            return func(*args, **kwargs)
+        return counted
+
+def seed_users(backend, namespace, users, rng): # existing members with some history, so the jobs have work to do
+    for user_id in range(1, users + 1):
+        backend.set_user(namespace, user_id, {
+            'points': rng.randint(0, 500),
+            'streak': rng.randint(0, 6),
+            'last_worksheet_date': str(date.today() - timedelta(days=rng.randint(0, 14))),
+            'first_worksheet_thisWeek_date': "2000-01-01",
+            'last_writing_date': "2000-01-01",
+            'last_speaking_date': "2000-01-01"
+        })
+
+def generate_messages(count, users, channels, rng): # mix of valid and invalid messages across the five tracked channels
+    messages = []
+    for _ in range(count):
+        author = FakeAuthor(rng.randint(1, users))
+        kind = rng.choice(["franco", "arabic", "speaking", "dictation", "worksheet"])
+        channel = channels[kind]
+        if kind in ("franco", "arabic"):
+            if rng.random() < 0.2:
+                message = FakeMessage(author, channel, attachments=[FakeAttachment("image/png")])
+            else:
+                message = FakeMessage(author, channel, "x" * rng.randint(5, 200))
+        elif kind == "speaking":
+            message = FakeMessage(author, channel, attachments=[FakeAttachment("audio/ogg", rng.uniform(1, 30))])
+        elif kind == "dictation":
+            attachments = [FakeAttachment("audio/ogg", rng.uniform(1, 10))] if rng.random() < 0.5 else []
+            message = FakeMessage(author, channel, "x" * rng.randint(0, 50), attachments)
+        else:
+            message = FakeMessage(author, channel, "x" * rng.randint(50, 400))
+        messages.append(message)
+    return messages
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def time_job(name, job, day, results):
+    main.date = fixed_date(day)
+    try:
+        start = time.perf_counter()
+        await job()
+        results[name] = round((time.perf_counter() - start) * 1000, 3)
+    finally:
+        main.date = date
+
+async def run(args):
+    rng = random.Random(args.seed)
+    channels = {name: FakeChannel(channel_id) for name, channel_id in CHANNELS.items()}
+    state = await fakes.setup_guild(main, channels, args.verbose) # main's log prints would dominate the timings
+    seed_users(main.backend, state.namespace, args.users, rng)
+    counting = CountingBackend(main.backend)
+    main.storage.backend = counting
+    messages = generate_messages(args.messages, args.users, channels, rng)
+
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(message):
+        async with semaphore:
+            start = time.perf_counter()
+            await main.on_message(message)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handle(message) for message in messages))
+    elapsed = time.perf_counter() - start
+    await main.flush_awards()
+    message_reads, message_writes = counting.reads, counting.writes # the awards are written by the journal flush, so it's counted with the messages
+    await state.leaderboard_refresher.flush()
+    await main.log_sink.flush()
+
+    jobs = {}
+    await time_job("check_streaks_ms", main.check_streaks, date.today(), jobs)
+    next_monday = date.today() + timedelta(days=7 - date.today().weekday()) # closes the week the messages were scored in
+    next_month = (date.today().replace(day=28) + timedelta(days=4)).replace(day=1)
+    await time_job("weekly_leaderboard_ms", main.weekly_leaderboard, next_monday, jobs)
+    await time_job("monthly_leaderboard_ms", main.monthly_leaderboard, next_month, jobs)
+
+    return {
+        "messages": args.messages,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "messages_per_second": round(args.messages / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "reads_per_message": round(message_reads / args.messages, 4),
+        "writes_per_message": round(message_writes / args.messages, 4),
+        "leaderboard_refreshes": state.leaderboard_refresher.stats(),
+        "leaderboard_edits": channels["leaderboard"].edits + channels["leaderboard"].sends,
+        "log_messages": channels["log"].sends,
+        **jobs,
+    }
+
+def compare(result, baseline): # prints how each number moved against a recorded baseline
+    for key, value in result.items():
+        old = baseline.get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            print(f"{key:>26}: {value:>12} (baseline {old}, {(value - old) / old * 100:+.1f}%)")
+        else:
+            print(f"{key:>26}: {value}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic load benchmark for the scoring path")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=1, help="messages handled at the same time, like bursts from the gateway")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep main's log prints")
+    parser.add_argument("--save", help="write the results to this json file, to use as a baseline")
+    parser.add_argument("--compare", help="compare the results against a baseline json file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    else:
+        print(json.dumps(result, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
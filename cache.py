@@ -0,0 +1,37 @@
+from collections import OrderedDict
+from backends import apply_changes
+
+class UserCache: # bounded LRU cache of user documents, kept in sync by the bot's own writes
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, user_id): # returns the cached document or None, and marks it as recently used
+        user_id = str(user_id)
+        user_data = self._data.get(user_id)
+        if user_data is None:
+            return None
+        self._data.move_to_end(user_id)
+        return user_data
+
+    def put(self, user_id, user_data):
+        user_id = str(user_id)
+        self._data[user_id] = dict(user_data)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size: # evicts the least recently used user
+            self._data.popitem(last=False)
+
+    def apply(self, user_id, changes): # mirrors an update() that was written to the db, only if the user is already cached
+        user_data = self._data.get(str(user_id))
+        if user_data is None:
+            return
+        apply_changes(user_data, changes)
+
+    def invalidate(self, user_id):
+        self._data.pop(str(user_id), None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,276 @@
+# Reproducible checks for the award journal's daily caps, the per user locks, the flush paths and the period closes
+# Runs the real handlers from main.py against the sqlite storage backend with the fakes from fakes.py, nothing is sent to discord
+# Every check uses its own users, prints ok or FAIL, and the script exits with 1 if any check failed
+# usage: python checks.py
+#        python checks.py --only double_flush
+import argparse
+import asyncio
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+import fakes
+from fakes import CHANNELS, FakeAuthor, FakeAttachment, FakeChannel, FakeMessage, FakeInteraction, fixed_date
+
+checks_dir = fakes.prepare("sqlite", "checks-", # sqlite is a blocking backend, so db calls really run on the storage threads and handlers interleave
+                           BACKFILL_BATCH_SIZE=7, # flushes several times in the middle of a replay
+                           BACKFILL_PROGRESS_SECONDS=0,
+                           PERIOD_CLOSE_RETRY_SECONDS=0)
+
+import main
+from discord.app_commands import Choice
+
+class FlakyBackend: # wraps the real backend, fails or slows down the next few journal flushes
+    def __init__(self, backend, lost_commits=0, failed_writes=0, failed_reads=0, delay=0):
+        self.backend = backend
+        self.blocking = backend.blocking
+        self.lost_commits = lost_commits # writes that commit and then raise, like a timeout after the commit
+        self.failed_writes = failed_writes # writes that raise without writing anything
+        self.failed_reads = failed_reads # flush marker reads that raise
+        self.delay = delay # seconds every write takes, so a second flush can start while the first batch is uncommitted
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def write_users(self, *args, **kwargs):
+        time.sleep(self.delay)
+        if self.failed_writes:
+            self.failed_writes -= 1
+            raise ConnectionError("write failed")
+        result = self.backend.write_users(*args, **kwargs)
+        if self.lost_commits:
+            self.lost_commits -= 1
+            raise TimeoutError("commit answer lost")
+        return result
+
+    def last_flush(self, journal_id):
+        if self.failed_reads:
+            self.failed_reads -= 1
+            raise ConnectionError("read failed")
+        return self.backend.last_flush(journal_id)
+
+@contextmanager
+def flaky(**failures): # usage: with flaky(failed_writes=1):
+    main.storage.backend = FlakyBackend(main.storage.backend, **failures)
+    try:
+        yield
+    finally:
+        main.storage.backend = main.storage.backend.backend
+
+@contextmanager
+def on_day(day): # main's date.today() returns day
+    main.date = fixed_date(day)
+    try:
+        yield
+    finally:
+        main.date = date
+
+failures = []
+
+def check(condition, what):
+    if not condition:
+        failures.append(what)
+
+def stored(state, user_id, field): # the value in the db, not the cache
+    return (main.backend.get_user(state.namespace, user_id) or {}).get(field)
+
+def writing(user_id, channels):
+    return FakeMessage(FakeAuthor(user_id), channels["franco"], "x" * 40)
+
+def worksheet(user_id, channels):
+    return FakeMessage(FakeAuthor(user_id), channels["worksheet"], "x" * 150)
+
+def dictation(user_id, channels):
+    return FakeMessage(FakeAuthor(user_id), channels["dictation"], "x" * 20, [FakeAttachment("audio/ogg", 5)])
+
+async def concurrent_messages(state, channels, rules): # a burst from one user only pays each daily award once, with the cache cold so every handler reads the db
+    user_id = 100
+    await asyncio.gather(*(main.on_message(writing(user_id, channels)) for _ in range(20)))
+    await asyncio.gather(*(main.on_message(dictation(user_id, channels)) for _ in range(20)))
+    await main.flush_awards()
+    expected = rules["text_points"] + rules["voice_points"] + rules["text_points"]
+    check(stored(state, user_id, 'points') == expected, f"20 writing and 20 dictation messages paid {stored(state, user_id, 'points')} points, expected {expected}")
+    check(state.user_locks.contended > 0, "the burst never waited on the user lock")
+    check(len(state.user_locks) == 0, f"{len(state.user_locks)} user locks left after the burst")
+
+async def double_flush(state, channels, rules): # two flushes at once write each award once
+    users = range(200, 210)
+    for user_id in users:
+        await main.on_message(writing(user_id, channels))
+    with flaky(delay=0.2):
+        await asyncio.gather(main.flush_awards(), main.flush_awards())
+    for user_id in users:
+        check(stored(state, user_id, 'points') == rules["text_points"], f"user {user_id} has {stored(state, user_id, 'points')} points after two concurrent flushes")
+
+async def lost_commit_retry(state, channels, rules): # the batch committed but the flush saw an error, the retry must not apply it again
+    user_id = 300
+    await main.on_message(writing(user_id, channels))
+    with flaky(lost_commits=1):
+        await main.flush_awards()
+        check(main.journal.pending_count() > 0, "the failed flush confirmed its batch")
+        await main.flush_awards()
+    check(stored(state, user_id, 'points') == rules["text_points"], f"retried flush left {stored(state, user_id, 'points')} points, expected {rules['text_points']}")
+    check(main.journal.pending_count() == 0, f"{main.journal.pending_count()} awards still waiting after the retry")
+
+async def reset_date(state, channels, rules): # /reset_date frees the daily cap, so the same day can be earned again
+    user_id = 400
+    member = FakeAuthor(user_id)
+    await main.on_message(writing(user_id, channels))
+    await main.reset_date.callback(FakeInteraction(), member, Choice(name="writing", value="last_writing_date"))
+    await main.on_message(writing(user_id, channels))
+    await main.on_message(writing(user_id, channels)) #the cap is back after the second award
+    await main.on_message(dictation(user_id, channels))
+    await main.reset_date.callback(FakeInteraction(), member, Choice(name="dictation", value="dictation"))
+    await main.on_message(dictation(user_id, channels))
+    await main.on_message(dictation(user_id, channels))
+    await main.flush_awards()
+    expected = 2 * rules["text_points"] + 2 * (rules["voice_points"] + rules["text_points"])
+    check(stored(state, user_id, 'points') == expected, f"reset_date left {stored(state, user_id, 'points')} points, expected {expected}")
+
+async def set_streak_over_pending(state, channels, rules): # /set_streak lands after a streak increment that is still in the journal
+    user_id = 500
+    await main.on_message(worksheet(user_id, channels))
+    await main.set_streak.callback(FakeInteraction(), FakeAuthor(user_id), 5)
+    await main.flush_awards()
+    check(stored(state, user_id, 'streak') == 5, f"streak is {stored(state, user_id, 'streak')} in the db after /set_streak 5")
+    state.user_cache.invalidate(user_id)
+    user_data = await main.check_user(writing(user_id, channels), state)
+    check(user_data['streak'] == 5, f"streak is {user_data['streak']} after a fresh read, a pending increment was applied over /set_streak")
+
+async def streak_sweep_over_pending(state, channels, rules): # the daily sweep doesn't reset a streak whose worksheet is still in the journal
+    user_id = 600
+    old = str(date.today() - timedelta(days=10))
+    main.backend.set_user(state.namespace, user_id, {
+        'points': 0,
+        'streak': 3,
+        'last_worksheet_date': old,
+        'first_worksheet_thisWeek_date': old,
+        'last_writing_date': "2000-01-01",
+        'last_speaking_date': "2000-01-01"
+    })
+    await main.on_message(worksheet(user_id, channels))
+    await main.check_streaks()
+    check(stored(state, user_id, 'streak') == 4, f"streak is {stored(state, user_id, 'streak')} after the sweep, expected 4")
+
+async def backfill_replay(state, channels, rules): # replaying the same history twice, with the flush loop running, pays it once
+    users = range(700, 710)
+    for user_id in users:
+        for _ in range(3):
+            channels["franco"].messages.append(writing(user_id, channels))
+        for _ in range(2):
+            channels["worksheet"].messages.append(worksheet(user_id, channels))
+    running = True
+
+    async def flush_loop():
+        while running:
+            await main.flush_awards()
+            await asyncio.sleep(0)
+
+    flusher = asyncio.create_task(flush_loop())
+    try:
+        today = date.today()
+        first = await main.run_backfill(state, channels["log"], today, today)
+        await main.flush_awards()
+        totals = {user_id: stored(state, user_id, 'points') for user_id in users}
+        again = await main.run_backfill(state, channels["log"], today, today)
+        await main.flush_awards()
+    finally:
+        running = False
+        await flusher
+    check(first == (50, 30), f"first replay scanned and recorded {first}, expected (50, 30)")
+    check(again == (50, 0), f"second replay scanned and recorded {again}, expected (50, 0)")
+    for user_id in users:
+        check(totals[user_id] and stored(state, user_id, 'points') == totals[user_id], f"user {user_id} went from {totals[user_id]} to {stored(state, user_id, 'points')} points on the second replay")
+    check(main.journal.pending_count() == 0, f"{main.journal.pending_count()} awards still waiting after the replays")
+
+async def marker_read_failure(state, channels, rules): # the marker read after a failed flush can fail too, flush_awards reports it instead of raising into the scheduled jobs
+    user_id = 800
+    await main.on_message(writing(user_id, channels))
+    with flaky(failed_writes=1, failed_reads=2):
+        first = await main.flush_awards() # the write fails
+        second = await main.flush_awards() # the marker read fails
+        await main.check_streaks() # so does the one in the sweep's flush, the sweep is skipped
+    check(first is False and second is False, f"flush_awards returned {first} and {second} while the db failed")
+    check(await main.flush_awards(), "the journal didn't drain once the db was back")
+    check(stored(state, user_id, 'points') == rules["text_points"], f"{stored(state, user_id, 'points')} points after the recovery, expected {rules['text_points']}")
+
+async def month_close_after_failed_flush(state, channels, rules): # the month isn't closed while last month's awards are stuck in the journal, the retry keeps the new month's points
+    user_id = 810
+    first = date.today().replace(day=1)
+    closed = first - timedelta(days=1)
+    with on_day(closed):
+        await main.on_message(writing(user_id, channels))
+    with on_day(first):
+        with flaky(failed_writes=1):
+            done = await main.monthly_leaderboard()
+        check(not done, "the month was closed although the journal didn't drain")
+        check(main.backend.get_history(state.namespace, main.month_field(closed)) is None, "the month was archived while its awards were waiting")
+        await main.on_message(writing(user_id, channels)) # earned in the new month before the retry
+        await main.flush_awards()
+        done = await main.monthly_leaderboard()
+    snapshot = main.backend.get_history(state.namespace, main.month_field(closed)) or {'users': [], 'points': []}
+    archived = dict(zip(snapshot['users'], snapshot['points']))
+    check(done is True, f"the retry returned {done}, the month isn't closed")
+    check(archived.get(str(user_id)) == rules["text_points"], f"the archive has {archived.get(str(user_id))} points for the user, expected {rules['text_points']}")
+    check(stored(state, user_id, 'points') == rules["text_points"], f"{stored(state, user_id, 'points')} points after the reset, expected the new month's {rules['text_points']}")
+    check(stored(state, user_id, main.month_field(closed)) is None, "the closed month's counter is still on the user")
+    ranked = {user: points for user, points, _ in state.ranking.top(len(state.ranking))}
+    check(ranked.get(str(user_id)) == rules["text_points"], f"the ranking has {ranked.get(str(user_id))} points, expected {rules['text_points']}")
+
+async def week_close_retry(state, channels, rules): # close_periods tries again when the first flush fails, and the week is archived with every award
+    user_id = 820
+    monday = date.today() - timedelta(days=date.today().weekday())
+    sunday = monday - timedelta(days=1)
+    with on_day(sunday):
+        await main.on_message(writing(user_id, channels))
+    with on_day(monday):
+        with flaky(failed_writes=1):
+            await main.close_periods()
+    snapshot = main.backend.get_history(state.namespace, main.week_field(sunday)) or {'users': [], 'points': []}
+    archived = dict(zip(snapshot['users'], snapshot['points']))
+    check(archived.get(str(user_id)) == rules["text_points"], f"the archive has {archived.get(str(user_id))} points for the user, expected {rules['text_points']}")
+    check(stored(state, user_id, main.week_field(sunday)) is None, "the closed week's counter is still on the user")
+
+CHECKS = {
+    "concurrent_messages": concurrent_messages,
+    "double_flush": double_flush,
+    "lost_commit_retry": lost_commit_retry,
+    "reset_date": reset_date,
+    "set_streak_over_pending": set_streak_over_pending,
+    "streak_sweep_over_pending": streak_sweep_over_pending,
+    "backfill_replay": backfill_replay,
+    "marker_read_failure": marker_read_failure,
+    "month_close_after_failed_flush": month_close_after_failed_flush, # moves the points reset, so the closes run last
+    "week_close_retry": week_close_retry,
+}
+
+async def run(args):
+    channels = {name: FakeChannel(channel_id) for name, channel_id in CHANNELS.items()}
+    state = await fakes.setup_guild(main, channels, args.verbose)
+    rules = state.routes[CHANNELS["franco"]][2]
+
+    failed = 0
+    for name, job in CHECKS.items():
+        if args.only and name not in args.only:
+            continue
+        del failures[:]
+        try:
+            await job(state, channels, rules)
+        except Exception as e:
+            failures.append(f"raised {e!r}")
+        if failures:
+            failed += 1
+            print(f"FAIL {name}")
+            for what in failures:
+                print(f"    {what}")
+        else:
+            print(f"ok   {name}")
+    await main.log_sink.flush()
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks for the journal caps, the user locks, the flush paths and the period closes")
+    parser.add_argument("--only", nargs="*", choices=list(CHECKS), help="run only these checks")
+    parser.add_argument("--verbose", action="store_true", help="keep main's log prints")
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(run(args)) else 0)
@@ -0,0 +1,131 @@
+# Fake discord objects and the offline setup shared by bench.py and checks.py, nothing is sent to discord
+# usage: directory = fakes.prepare("memory", "bench-") before importing main, then state = await fakes.setup_guild(main, channels)
+import asyncio
+import itertools
+import os
+import tempfile
+from datetime import date, datetime, timezone
+
+CHANNELS = {
+    "franco": 1001,
+    "arabic": 1002,
+    "speaking": 1003,
+    "dictation": 1004,
+    "worksheet": 1005,
+    "leaderboard": 1006,
+    "weekly": 1007,
+    "log": 1008,
+}
+
+ids = itertools.count(1) # message and interaction ids, unique for the whole run
+
+def prepare(backend, prefix, **settings): # has to run before main is imported, main reads its settings at import time
+    directory = tempfile.mkdtemp(prefix=prefix)
+    os.environ["DISCORD_TOKEN"] = "offline"
+    os.environ["STORAGE_BACKEND"] = backend
+    os.environ["SQLITE_PATH"] = os.path.join(directory, "bot.db")
+    os.environ["JOURNAL_PATH"] = os.path.join(directory, "awards.db")
+    os.environ["LOG_FILE"] = os.path.join(directory, "events.log")
+    for key, value in settings.items():
+        os.environ[key] = str(value)
+    return directory
+
+class FakeAuthor:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+        self.name = str(user_id)
+        self.bot = False
+
+class FakeAttachment:
+    def __init__(self, content_type, duration=None):
+        self.content_type = content_type
+        self.duration = duration
+
+    def is_voice_message(self):
+        return self.duration is not None
+
+class FakeSentMessage:
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, **kwargs):
+        self.channel.edits += 1
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+        self.sends = 0
+        self.edits = 0
+        self.messages = [] # what history() returns, oldest first
+
+    async def send(self, *args, **kwargs):
+        self.sends += 1
+        return FakeSentMessage(self, next(ids))
+
+    def get_partial_message(self, message_id):
+        return FakeSentMessage(self, message_id)
+
+    async def history(self, limit=None, after=None, before=None, oldest_first=True):
+        for message in self.messages:
+            if (after is None or message.created_at > after) and (before is None or message.created_at < before):
+                await asyncio.sleep(0) # a page boundary, lets the flush loop and live messages run
+                yield message
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+GUILD = FakeGuild(1000)
+
+class FakeMessage:
+    def __init__(self, author, channel, content="", attachments=None):
+        self.id = next(ids)
+        self.author = author
+        self.channel = channel
+        self.guild = GUILD
+        self.content = content
+        self.attachments = attachments or []
+        self.created_at = datetime.now(timezone.utc)
+
+class FakeResponse:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+class FakeInteraction: # what the slash command callbacks read from an interaction
+    def __init__(self):
+        self.id = next(ids)
+        self.guild_id = GUILD.id
+        self.user = FakeAuthor(1)
+        self.response = FakeResponse()
+
+def fixed_date(day): # date class whose today() returns the given day, used to make the daily jobs run
+    class FixedDate(date):
+        @classmethod
+        def today(cls):
+            return cls(day.year, day.month, day.day)
+    return FixedDate
+
+async def setup_guild(main, channels, verbose=False): # points the fake server's config at the fake channels, returns its state
+    async def no_commands(message):
+        return None
+
+    if not verbose: # main prints every log line
+        main.print = lambda *a, **k: None
+    main.bot.process_commands = no_commands
+    main.bot.get_channel = {channel.id: channel for channel in channels.values()}.get
+    state = await main.get_state(GUILD.id)
+    state.config.update({
+        "franco_channel_id": CHANNELS["franco"],
+        "arabic_channel_id": CHANNELS["arabic"],
+        "speaking_channel_id": CHANNELS["speaking"],
+        "dictation_channel_id": CHANNELS["dictation"],
+        "worksheet_channel_id": CHANNELS["worksheet"],
+        "leaderboard_channel_id": CHANNELS["leaderboard"],
+        "weekly_leaderboard_id": CHANNELS["weekly"],
+        "log_channel_id": CHANNELS["log"],
+    })
+    state.compile_routes()
+    return state
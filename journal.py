@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import time
+import uuid
+from backends import Increment
+
+class AwardJournal: # local append only journal of awards, flushed to firestore in the background
+    # flushed is 0 while an award waits, 2 once it's claimed into a batch, and 1 when its batch is known to be in the db
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL") # appends don't block the flusher's reads, and survive a crash
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS awards (
+            message_id TEXT PRIMARY KEY,
+            guild TEXT NOT NULL DEFAULT '',
+            user_id TEXT NOT NULL,
+            changes TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            flushed INTEGER NOT NULL DEFAULT 0
+        )""")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(awards)")]
+        if "guild" not in columns: # journals from before servers had their own namespace
+            self._conn.execute("ALTER TABLE awards ADD COLUMN guild TEXT NOT NULL DEFAULT ''")
+        if "batch" not in columns: # journals from before flushes were claimed in batches
+            self._conn.execute("ALTER TABLE awards ADD COLUMN batch TEXT")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('journal_id', ?)", (uuid.uuid4().hex,))
+        self.journal_id = self._conn.execute("SELECT value FROM meta WHERE key = 'journal_id'").fetchone()[0] # names this journal's flush marker in the db
+        self._conn.execute("CREATE INDEX IF NOT EXISTS awards_pending ON awards (flushed, user_id)")
+        self._conn.commit()
+        self._pending = self._conn.execute("SELECT COUNT(*) FROM awards WHERE flushed != 1").fetchone()[0] # kept in memory so other threads (like /metrics) can read it
+        self.recorded = 0 # awards recorded since startup, used by /backfill to report progress
+
+    def record(self, message_id, namespace, user_id, changes): # returns False if this message was already recorded, so it's only applied once
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO awards (message_id, guild, user_id, changes, created_at) VALUES (?, ?, ?, ?, ?)",
+            (str(message_id), namespace or "", str(user_id), self._encode(changes), time.time()))
+        self._conn.commit()
+        if cursor.rowcount != 1:
+            return False
+        self._pending += 1
+        self.recorded += 1
+        return True
+
+    def pending(self, limit): # oldest awards not known to be in the db as [(message id, namespace, user id, changes)]
+        rows = self._conn.execute(
+            "SELECT message_id, guild, user_id, changes FROM awards WHERE flushed != 1 ORDER BY created_at, rowid LIMIT ?", (limit,)).fetchall()
+        return [(message_id, guild or None, user_id, self._decode(changes)) for message_id, guild, user_id, changes in rows]
+
+    def pending_for(self, namespace, user_id): # unflushed changes of one user, applied on top of a fresh db read
+        rows = self._conn.execute(
+            "SELECT changes FROM awards WHERE flushed != 1 AND user_id = ? AND guild = ? ORDER BY created_at, rowid", (str(user_id), namespace or "")).fetchall()
+        return [self._decode(changes) for (changes,) in rows]
+
+    def claim(self, limit): # puts the oldest waiting awards into batches, one per namespace, and returns the claimed batches
+        rows = self._conn.execute(
+            "SELECT message_id, guild FROM awards WHERE flushed = 0 ORDER BY created_at, rowid LIMIT ?", (limit,)).fetchall()
+        batches = {} # namespace -> batch id, a db batch only writes to one server's users
+        updates = []
+        for message_id, guild in rows:
+            if guild not in batches:
+                batches[guild] = uuid.uuid4().hex
+            updates.append((batches[guild], message_id))
+        self._conn.executemany("UPDATE awards SET flushed = 2, batch = ? WHERE message_id = ?", updates)
+        self._conn.commit()
+        return self.claimed()
+
+    def claimed(self): # batches claimed but not confirmed, oldest first, as [(batch id, namespace, [(user id, changes)])]
+        batches = {}
+        rows = self._conn.execute("SELECT batch, guild, user_id, changes FROM awards WHERE flushed = 2 ORDER BY created_at, rowid").fetchall()
+        for batch, guild, user_id, changes in rows:
+            if batch not in batches:
+                batches[batch] = (batch, guild or None, [])
+            batches[batch][2].append((user_id, self._decode(changes)))
+        return list(batches.values())
+
+    def mark_flushed(self, batch):
+        cursor = self._conn.execute("UPDATE awards SET flushed = 1 WHERE batch = ? AND flushed = 2", (batch,))
+        self._conn.commit()
+        self._pending -= cursor.rowcount
+
+    def release(self, message_id, reason): # renames a recorded key so it can be recorded again, the award itself is kept and still flushed
+        cursor = self._conn.execute("UPDATE awards SET message_id = message_id || ':released:' || ? WHERE message_id = ?", (str(reason), str(message_id)))
+        self._conn.commit()
+        return cursor.rowcount == 1
+
+    def pending_count(self):
+        return self._pending
+
+    def prune(self, older_than): # drops flushed awards older than the given number of seconds, keeps the file small
+        self._conn.execute("DELETE FROM awards WHERE flushed = 1 AND created_at < ?", (time.time() - older_than,))
+        self._conn.commit()
+
+    def _encode(self, changes): # increments are stored as {"increment": n} so they can be rebuilt after a restart
+        encoded = {}
+        for key, value in changes.items():
+            encoded[key] = {"increment": value.value} if isinstance(value, Increment) else value
+        return json.dumps(encoded)
+
+    def _decode(self, text):
+        changes = {}
+        for key, value in json.loads(text).items():
+            changes[key] = Increment(value["increment"]) if isinstance(value, dict) and "increment" in value else value
+        return changes
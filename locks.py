@@ -0,0 +1,27 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+class KeyedLocks: # one asyncio lock per key, so work on the same key runs one at a time while different keys run in parallel
+    def __init__(self):
+        self._locks = {} # key -> [lock, holders and waiters], only keys someone is using are kept
+        self.contended = 0 # how many times someone had to wait for the key
+
+    @asynccontextmanager
+    async def lock(self, key): # usage: async with locks.lock(user_id):
+        key = str(key)
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.contended += 1
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0: # evicted as soon as nobody holds or waits on it, so the table only grows with concurrent users
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
@@ -0,0 +1,64 @@
+import asyncio
+from datetime import datetime
+import metrics
+
+class LogSink: # writes log lines to a local file right away, and sends them to discord in packed batches
+    def __init__(self, send, path, max_queue, interval, max_chars=1900):
+        self.send = send # async function that sends one packed message to a destination, send(destination, text)
+        self.interval = interval # seconds between two flushes
+        self.max_chars = max_chars # discord messages are capped at 2000 characters
+        self.dropped = 0 # dropped since the last flush, reported in the next message
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._file = open(path, "a", encoding="utf-8", buffering=1) # line buffered, so every line is on disk immediately
+        self._task = None
+
+    def write(self, line, destination=None): # never waits, if the queue is full or there's no destination the line only goes to the file
+        self._file.write(f"{datetime.now().isoformat(timespec='seconds')} {line}\n")
+        if destination is None:
+            return
+        try:
+            self._queue.put_nowait((destination, line))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.log_lines_dropped.inc()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def depth(self):
+        return self._queue.qsize()
+
+    async def flush(self):
+        lines = {} # destination -> lines, each server's log channel gets its own packed messages
+        while not self._queue.empty():
+            destination, line = self._queue.get_nowait()
+            lines.setdefault(destination, []).append(line)
+        if self.dropped and lines: # kept for the next flush if there's nowhere to report it yet
+            for destination_lines in lines.values():
+                destination_lines.append(f"⚠️ {self.dropped} log lines were dropped because the log queue was full, check the log file")
+            self.dropped = 0
+        for destination, destination_lines in lines.items():
+            for chunk in self._pack(destination_lines):
+                try:
+                    await self.send(destination, chunk)
+                    metrics.log_messages_sent.inc()
+                except Exception as e:
+                    print(f"Failed to send log to Discord: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def _pack(self, lines): # joins as many lines as fit into each message
+        chunk = ""
+        for line in lines:
+            if len(line) > self.max_chars:
+                line = line[:self.max_chars - 3] + "..."
+            if chunk and len(chunk) + len(line) + 1 > self.max_chars:
+                yield chunk
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line
+        if chunk:
+            yield chunk
@@ -5,31 +5,66 @@ from discord import app_commands
 from discord.app_commands import Choice
 from discord.ext import tasks
 import logging
+import asyncio
 from dotenv import load_dotenv
 import os
-import json
 import webserver
-import firebase_admin
-from firebase_admin import credentials, firestore
-from datetime import date, time
+from scheduler import RefreshScheduler
+from cache import UserCache
+from storage import Storage
+from backends import Increment, Delete, apply_changes, create_backend
+from ranking import Ranking
+from logsink import LogSink
+from journal import AwardJournal
+from locks import KeyedLocks
+from backfill import prefetch
+from datetime import date, datetime, time, timedelta
+from time import perf_counter
+import metrics
 
 # TO DO LIST
 # REMINDER MESSAGES WHEN THEIR STREAK IS ABOUT TO RUN OUT
 # MAYBE USER DMS OR SOMEWAY TO INDICATE THAT THEY GAINED POINTS OR STREAK
 # HELP COMMAND
 
-# Loads the discord token and the firebase creds
+# Loads the discord token and the storage settings
 load_dotenv()
 token = os.getenv("DISCORD_TOKEN")
-firebase_creds_string = os.getenv("FIREBASE_CREDS")
-if not all([token, firebase_creds_string]):
+storage_backend = os.getenv("STORAGE_BACKEND", "firestore") #firestore, sqlite or memory
+firebase_creds_string = os.getenv("FIREBASE_CREDS") #only needed for the firestore backend
+sqlite_path = os.getenv("SQLITE_PATH", "bot.db") #only used by the sqlite backend
+leaderboard_refresh_seconds = float(os.getenv("LEADERBOARD_REFRESH_SECONDS", "30")) #minimum time between two live leaderboard rebuilds
+user_cache_size = int(os.getenv("USER_CACHE_SIZE", "1000")) #max number of user documents kept in memory
+firestore_workers = int(os.getenv("FIRESTORE_WORKERS", "8")) #threads used for the blocking firestore calls
+firestore_concurrency = int(os.getenv("FIRESTORE_CONCURRENCY", "16")) #max firestore calls in flight at once
+firestore_timeout = float(os.getenv("FIRESTORE_TIMEOUT", "10")) #seconds before a single firestore call is given up on
+firestore_scan_timeout = float(os.getenv("FIRESTORE_SCAN_TIMEOUT", "60")) #longer timeout for reading the whole users collection
+streak_page_size = int(os.getenv("STREAK_PAGE_SIZE", "300")) #how many expiring streaks are read per page in check_streaks
+live_leaderboard_size = int(os.getenv("LIVE_LEADERBOARD_SIZE", "75")) #how many users are shown on the live leaderboard message
+log_file = os.getenv("LOG_FILE", "events.log") #every log line is written here immediately
+log_queue_size = int(os.getenv("LOG_QUEUE_SIZE", "1000")) #log lines waiting to be sent to discord, extra lines are dropped and counted
+log_flush_seconds = float(os.getenv("LOG_FLUSH_SECONDS", "10")) #how often the queued log lines are sent to the log channel
+journal_path = os.getenv("JOURNAL_PATH", "awards.db") #local sqlite file where every award is recorded before it reaches firestore
+journal_flush_seconds = float(os.getenv("JOURNAL_FLUSH_SECONDS", "5")) #how often the journaled awards are pushed to firestore
+journal_retention_days = int(os.getenv("JOURNAL_RETENTION_DAYS", "7")) #how long flushed awards are kept for dedup, /backfill can't go further back than this
+period_close_retries = int(os.getenv("PERIOD_CLOSE_RETRIES", "12")) #how many more times the midnight close is tried when the award journal can't be flushed
+period_close_retry_seconds = float(os.getenv("PERIOD_CLOSE_RETRY_SECONDS", "300")) #wait between two tries
+backfill_prefetch = int(os.getenv("BACKFILL_PREFETCH", "200")) #history messages read ahead while /backfill scores, two pages of 100
+backfill_batch_size = int(os.getenv("BACKFILL_BATCH_SIZE", "500")) #messages replayed between two journal flushes during /backfill
+backfill_progress_seconds = float(os.getenv("BACKFILL_PROGRESS_SECONDS", "15")) #how often /backfill edits its progress message
+multi_guild = os.getenv("MULTI_GUILD", "false").lower() == "true" #true to serve many servers, each one with its own config and users
+shard_count = os.getenv("SHARD_COUNT") #"auto" or a number to use the sharded bot, unset for a single connection
+shard_ids = os.getenv("SHARD_IDS") #comma separated shards this process runs, when the shards are split over a few processes
+guild_fanout = int(os.getenv("GUILD_FANOUT", "4")) #how many servers the scheduled jobs process at the same time
+if not token or (storage_backend == "firestore" and not firebase_creds_string):
     print("Missing one or more environment variables")
     exit()
+if shard_ids and (not shard_count or shard_count == "auto"): #discord.py needs the total to know which servers the listed shards get
+    print("SHARD_IDS needs SHARD_COUNT set to the total number of shards, not auto")
+    exit()
 
-firebase_dict = json.loads(firebase_creds_string)
-creds = credentials.Certificate(firebase_dict)
-firebase_admin.initialize_app(creds)
-db = firestore.client()
+backend = create_backend(storage_backend, firebase_creds_string, sqlite_path) #blocking calls, only used directly at startup
+storage = Storage(backend, firestore_workers, firestore_concurrency, firestore_timeout, firestore_scan_timeout) #every db call made from async code goes through storage
 
 # Discord intents and logging handling
 handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
@@ -39,50 +74,216 @@ intents.message_content = True
 intents.voice_states = True
 intents.members = True
 intents.reactions = True
-bot = commands.Bot(command_prefix='.', intents=intents)
+if shard_count: #discord requires sharding past 2500 servers, each shard is its own gateway connection
+    bot = commands.AutoShardedBot(command_prefix='.', intents=intents, shard_count=None if shard_count == "auto" else int(shard_count),
+                                  shard_ids=[int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else None)
+else:
+    bot = commands.Bot(command_prefix='.', intents=intents)
 
 # Functions Section
 
-def load_config(): #function for loading the config, used to create local var config
+default_scoring = { #point values and thresholds, stored under "scoring" in the config so admins can tune them without a restart
+    "text_points": 10,
+    "voice_points": 15,
+    "worksheet_points": 20,
+    "weekly_bonuspercent": 10,
+    "max_streak_bonus": 4,
+    "min_worksheet_length": 100,
+    "min_dictation_length": 10,
+    "min_dictation_voice_length": 3,
+    "min_written_length": 20,
+    "min_speaking_length": 5
+}
+
+default_config = { #fallback config if there is an empty key/whole db is empty
+    "server_id" : None,
+    "admin1" : None,
+    "admin2" : None,
+    "arabic_channel_id" : None,
+    "franco_channel_id": None,
+    "speaking_channel_id" : None,
+    "dictation_channel_id" : None,
+    "worksheet_channel_id" : None,
+    "leaderboard_channel_id": None,
+    "leaderboard_message_id": None,
+    "weekly_leaderboard_id": None,
+    "log_channel_id" : None
+}
+
+def parse_config(data): #turns the settings document into the local config, and returns the missing keys with their defaults
     config = {} #create an empty config dict
-    default_config = { #fallback config if there is an empty key/whole db is empty
-        "server_id" : None,
-        "admin1" : None,
-        "admin2" : None,
-        "arabic_channel_id" : None,
-        "franco_channel_id": None,
-        "speaking_channel_id" : None,
-        "dictation_channel_id" : None,
-        "worksheet_channel_id" : None,
-        "leaderboard_channel_id": None,
-        "leaderboard_message_id": None,
-        "weekly_leaderboard_id": None,
-        "log_channel_id" : None
-    }
-    raw_config = db.collection('config').document('settings').get()
-    if raw_config.exists: #ensures that the config exists, then converts the snapshot to a dict
-        data = raw_config.to_dict()
-        for key in default_config.keys(): #convers the server id to int, and in the future any extra id
-            if data.get(key) is not None: #.get not [key] to prevent crashing
-                config[key] = int(data[key])
-            else:  #if not found, set the key from the default config to the db, and load from local the default config for the key
-                db.collection('config').document('settings').set({key:default_config[key]}, merge=True)
-                config[key] = default_config[key]
-        print("Config loaded successfully")
+    missing = {}
+    for key in default_config.keys(): #convers the server id to int, and in the future any extra id
+        if data.get(key) is not None: #.get not [key] to prevent crashing
+            config[key] = int(data[key])
+        else: #if not found, load from local the default config for the key
+            missing[key] = default_config[key]
+            config[key] = default_config[key]
+    scoring = {key: int(value) for key, value in (data.get("scoring") or {}).items()}
+    if any(key not in scoring for key in default_scoring): #missing scoring rules
+        scoring = {**default_scoring, **scoring}
+        missing["scoring"] = scoring
+    config["scoring"] = scoring
+    return config, missing
+
+def load_config(namespace): #function for loading the config of one server, blocking, so async code runs it through storage.run
+    data = backend.get_config(namespace)
+    if data is not None: #ensures that the config exists
+        config, missing = parse_config(data)
+        if missing: #heals all the missing keys in one write
+            backend.set_config(namespace, missing, merge=True)
+        print(f"Config loaded successfully for {namespace or 'the main server'}")
     else: #if the document doesn't exist, create it using the default config
-        print(f"Failed to load config, loading default config")
-        db.collection('config').document('settings').set(default_config)
-        config = default_config.copy()
+        print(f"Failed to load config for {namespace or 'the main server'}, loading default config")
+        data = {} if namespace is None else {"server_id": namespace} #a new server's id is already known, so it doesn't need .setserver
+        config, missing = parse_config(data)
+        backend.set_config(namespace, {**missing, **data}, merge=False)
     return config
 
-config = load_config()
-
-async def check_user(message): #it checks that the message author is not the bot, or one of the admins, if not, it returns the user data as a dict
-    if message.author == bot.user or message.author.id == config["admin1"] or message.author.id == config["admin2"]:
+class GuildState: #everything kept in memory for one server, found by namespace in guilds
+    def __init__(self, namespace, config):
+        self.namespace = namespace #None for the main server, which keeps the original config/settings document and users collection
+        self.config = config
+        self.routes = {} #channel id -> (channel type, scoring function, scoring rules), rebuilt by compile_routes
+        self.user_cache = UserCache(user_cache_size)
+        self.ranking = Ranking() #users sorted by points, loaded once from the db then kept up to date by the bot's own writes
+        self.leaderboard_fingerprint = None #fingerprint of what the live leaderboard message currently shows
+        self.leaderboard_refresher = RefreshScheduler(lambda: update_leaderboard(self), leaderboard_refresh_seconds) #used instead of calling update_leaderboard directly, so bursts of points only rebuild it once
+        self.user_locks = KeyedLocks() #serializes the scoring of each user's messages
+        self.backfill_running = False
+
+    def compile_routes(self): #rebuilds the dispatch table from the config, called whenever the config changes
+        rules = {**default_scoring, **self.config.get("scoring", {})}
+        compiled = {}
+        for key, channel_type, score in channel_rules:
+            if self.config.get(key) is not None:
+                compiled[self.config[key]] = (channel_type, score, rules)
+        self.routes = compiled
+
+guilds = {} #namespace -> GuildState, filled as servers are seen
+guild_loads = {} #namespace -> task loading it, so a burst of messages from a new server only loads its config once
+
+if multi_guild:
+    legacy_config = backend.get_config(None) or {}
+    legacy_server_id = int(legacy_config["server_id"]) if legacy_config.get("server_id") else None #the server from before multi guild mode keeps its data where it was
+else:
+    legacy_server_id = None
+    guilds[None] = GuildState(None, load_config(None))
+
+journal = AwardJournal(journal_path)
+
+def namespace_for(guild_id): #storage namespace of a server
+    if not multi_guild or (guild_id is not None and guild_id == legacy_server_id):
         return None
+    return str(guild_id)
+
+async def get_state(guild_id): #the state of a server, loading its config the first time it's seen
+    namespace = namespace_for(guild_id)
+    state = guilds.get(namespace)
+    if state is not None:
+        return state
+    task = guild_loads.get(namespace)
+    if task is None:
+        task = guild_loads[namespace] = asyncio.create_task(load_guild(namespace))
+    return await task
+
+async def load_guild(namespace):
+    try:
+        state = GuildState(namespace, await storage.run(load_config, namespace))
+        state.compile_routes()
+        guilds[namespace] = state
+        return state
+    finally:
+        guild_loads.pop(namespace, None)
+
+async def for_each_guild(job): #runs a scheduled job for every server, guild_fanout servers at a time
+    semaphore = asyncio.Semaphore(guild_fanout)
+    targets = {namespace: None for namespace in guilds}
+    targets.update({namespace_for(guild.id): guild.id for guild in bot.guilds}) #in single server mode every guild maps to the same namespace, so it runs once
+    async def run(namespace, guild_id):
+        async with semaphore:
+            try:
+                await job(guilds.get(namespace) or await get_state(guild_id))
+            except Exception as e: #one broken server shouldn't stop the others
+                print(f"{job.__name__} failed for {namespace or 'the main server'}: {e}")
+    await asyncio.gather(*(run(namespace, guild_id) for namespace, guild_id in targets.items()))
+
+def daily_key(kind, state, user_id, today): #journal key of a once a day award
+    return f"{kind}:{state.namespace or ''}:{user_id}:{today}"
+
+daily_caps = { #what /reset_date choice frees which daily awards, so the user can earn them again today
+    "last_writing_date": ("writing",),
+    "last_speaking_date": ("speaking",),
+    "dictation": ("dictation_voice", "dictation_text")
+}
+
+def release_daily_caps(state, user_id, choice, reason):
+    for kind in daily_caps.get(choice, ()):
+        journal.release(daily_key(kind, state, user_id, str(date.today())), reason)
+
+async def award(message, state, changes, kind, today, daily=False): #records the award in the local journal and applies it to the cache and ranking, flush_journal writes it to the db later
+    changes = with_periods(changes, date.fromisoformat(today))
+    if daily: #keyed by user and day instead of message, so a second award the same day is refused by the journal's primary key even if the cached dates are stale
+        key = daily_key(kind, state, message.author.id, today)
+    else: #the same message can't be paid twice for the same kind of award
+        key = f"{message.id}:{kind}"
+    cached = state.user_cache.get(message.author.id)
+    if cached is not None: #dates only move forward, a replayed award from an earlier day mustn't reopen today's daily checks
+        changes = {field: value for field, value in changes.items() if not (field.endswith('_date') and cached.get(field, "") > value)}
+    if not journal.record(key, state.namespace, message.author.id, changes):
+        return False
+    state.user_cache.apply(message.author.id, changes)
+    state.ranking.apply(message.author.id, changes)
+    return True
+
+flush_lock = asyncio.Lock() #the journal loop, the scheduled jobs and /backfill all flush, two flushes at once would write the same awards twice
+
+async def flush_awards(): #pushes the journaled awards to the db, returns False if some are still waiting because the db failed
+    async with flush_lock:
+        return await flush_locked()
+
+async def flush_locked(): #same as flush_awards, for callers that already hold flush_lock, one batch of up to 499 awards plus the flush marker at a time
+    try:
+        leftover = journal.claimed()
+        if leftover and await storage.last_flush(journal.journal_id) == leftover[0][0]: #the last attempt committed but the answer was lost, so it must not be written again
+            journal.mark_flushed(leftover[0][0])
+    except Exception as e: #only checked after a failed flush, when the db is likely still failing, the batch stays claimed for the next try
+        print(f"Failed to check the last flush, {journal.pending_count()} awards waiting: {e}")
+        return False
+    flushed = 0
+    drained = True
+    while True:
+        batches = journal.claimed() or journal.claim(499)
+        if not batches:
+            break
+        batch, namespace, writes = batches[0]
+        try:
+            await storage.flush_batch(namespace, writes, (journal.journal_id, batch))
+        except Exception as e: #stays claimed, the next flush checks the marker before trying again
+            print(f"Failed to flush {len(writes)} awards, {journal.pending_count()} awards waiting: {e}")
+            drained = False
+            break
+        journal.mark_flushed(batch) #marked before the next batch is written, so only the last batch can ever be in doubt
+        flushed += len(writes)
+    if flushed:
+        journal.prune(journal_retention_days * 24 * 3600) #keeps the flushed awards for dedup (and /backfill) for a while, older ones are removed
+    return drained
+
+async def admin_change(interaction, state, user_id, changes): #admin edits go through the journal like awards, so they land in order with the awards that are still waiting
+    journal.record(f"admin:{interaction.id}:{user_id}", state.namespace, user_id, changes)
+    state.user_cache.apply(user_id, changes)
+    state.ranking.apply(user_id, changes)
+
+async def check_user(message, state): #it checks that the message author is not the bot, or one of the admins, if not, it returns the user data as a dict
+    if message.author == bot.user or message.author.id == state.config["admin1"] or message.author.id == state.config["admin2"]:
+        return None
+
+    cached = state.user_cache.get(message.author.id)
+    metrics.user_cache_lookups.inc("miss" if cached is None else "hit")
+    if cached is not None: #cached documents are already healed, so no db read is needed
+        return cached
 
-    doc_ref = db.collection('users').document(f'{str(message.author.id)}')
-    doc = doc_ref.get()
+    user_data = await storage.get_user(state.namespace, message.author.id)
 
     default_user = {
         'points': 0,
@@ -93,10 +294,10 @@ async def check_user(message): #it checks that the message author is not the bot
         'last_speaking_date': "2000-01-01"
     }
 
-    if not doc.exists: #writes a new document with default values in case the author wasn't in the db
-        doc_ref.set(default_user)
-        return default_user
-    user_data = doc.to_dict()
+    if user_data is None: #writes a new document with default values in case the author wasn't in the db
+        await storage.set_user(state.namespace, message.author.id, default_user)
+        state.ranking.apply(message.author.id, default_user)
+        user_data = default_user
     needs_update = False
 
     for key, value in default_user.items():
@@ -104,175 +305,460 @@ async def check_user(message): #it checks that the message author is not the bot
             user_data[key] = value
             needs_update = True
     if needs_update:
-        doc_ref.set(user_data, merge=True)
-        await log(f"Healed document {message.author.mention}'s data from missing fields\nDocument ID: {message.author.id}")
+        await storage.set_user(state.namespace, message.author.id, user_data, merge=True)
+        await log(f"Healed document {message.author.mention}'s data from missing fields\nDocument ID: {message.author.id}", state)
+    for changes in journal.pending_for(state.namespace, message.author.id): #awards that didn't reach the db yet
+        apply_changes(user_data, changes)
+    state.user_cache.put(message.author.id, user_data) #the cache keeps its own copy, and with USER_CACHE_SIZE=0 it keeps nothing, so the local dict is returned
     return user_data
 
 
-async def update_leaderboard(): #function to update the leaderboard
-    user_data = db.collection('users').get()
-    docs = [{ 'id': doc.id, **doc.to_dict()} for doc in user_data] # added the discord ID (name of the document) to the user_data dict
-    sorted_data = sorted(docs, key=lambda x: x['points'], reverse=True) #sorts the data by points, reverse to get descending order
+async def load_ranking(state): #reads every user once to build the ranking, after that it is updated in place
+    if state.ranking.loaded:
+        return
+    state.ranking.load(await storage.scan_users(state.namespace)) # each user dict has the discord ID (name of the document) under 'id'
+    for _, namespace, user_id, changes in journal.pending(-1): #awards that didn't reach the db yet
+        if namespace == state.namespace:
+            state.ranking.apply(user_id, changes)
+
+leaderboard_thumbnail = "https://i.ibb.co/BKLCTWv5/4ab2bbcfa5b9a10891406d2a84e94004.webp"
+leaderboard_page_size = 25 #discord allows at most 25 fields per embed
+
+display_names = {} #member id -> display name, so rendering doesn't look every member up again, cleared when the member changes
+
+def display_name(user_id):
+    name = display_names.get(str(user_id))
+    if name is None:
+        member = bot.get_user(int(user_id))
+        if member is None: # fallback if the member isn't the bot's memory for some reason, not cached so they show up once they are
+            return "Unknown User"
+        name = display_names[str(user_id)] = member.display_name
+    return name
+
+def render_rows(rows): #(user id, points, streak) rows -> (display name, points, streak) rows, what actually ends up in the embeds
+    return [(display_name(user_id), int(points), int(streak)) for user_id, points, streak in rows]
+
+def build_leaderboard_embeds(title, rows): #turns ranked (display name, points, streak) rows into pages of embeds
+    embeds = []
+    for start in range(0, len(rows), leaderboard_page_size):
+        page_number = start // leaderboard_page_size + 1
+        embed = discord.Embed(title=title if page_number == 1 else f"{title} (page {page_number})", color=discord.Color.gold())
+        for i, (name, points, streak) in enumerate(rows[start:start + leaderboard_page_size], start=start): #enumerate adds numbers to each row, used to display the rankings
+            embed.add_field( #adds field with each user to the page
+                name=f"#{i + 1} {name}",
+                value=f"Points: {points} | Worksheet Streak: {streak}",
+                inline=False
+            )
+        embeds.append(embed)
+    if not embeds: #nobody has points yet
+        embeds.append(discord.Embed(title=title, description="No users yet", color=discord.Color.gold()))
+    embeds[0].set_thumbnail(url=leaderboard_thumbnail) #sets a thumbnail on the first page
+    embeds[-1].timestamp = discord.utils.utcnow() #adds a timestamp at the bottom of the last page
+    return embeds
+
+def group_embeds(embeds): #groups the pages into messages, discord allows 10 embeds and 6000 characters per message
+    groups = [[]]
+    size = 0
+    for embed in embeds:
+        if groups[-1] and (len(groups[-1]) == 10 or size + len(embed) > 6000):
+            groups.append([])
+            size = 0
+        groups[-1].append(embed)
+        size += len(embed)
+    return groups
+
+async def send_leaderboard(channel, title, rows): #posts a full ranking of (user id, points, streak) rows, split over as many messages as needed
+    for group in group_embeds(build_leaderboard_embeds(title, render_rows(rows))):
+        await channel.send(embeds=group)
+
+async def update_leaderboard(state): #function to update the leaderboard
+    config = state.config
+    start = perf_counter()
+    await load_ranking(state)
+    rows = render_rows(state.ranking.top(live_leaderboard_size))
+    fingerprint = hash(tuple(rows))
+    if fingerprint == state.leaderboard_fingerprint and config.get('leaderboard_message_id'): #nothing visible changed, so no discord call
+        metrics.leaderboard_unchanged.inc()
+        return
     channel = bot.get_channel(config["leaderboard_channel_id"])
-    embed = discord.Embed(title="🏆 Leaderboard", color=discord.Color.gold()) #creates an embed with only the title and colour
-    embed.set_thumbnail(url="https://i.ibb.co/BKLCTWv5/4ab2bbcfa5b9a10891406d2a84e94004.webp") #sets a thumbnail to the embed
-    embed.timestamp = discord.utils.utcnow() #adds a timestamp at the bottom of the embed
-    for i, user in enumerate(sorted_data): #enumerate adds numbers to each item in the dict, used to display the rankings
-        member = bot.get_user(int(user['id']))
-        display_name = member.display_name if member else "Unknown User" # fallback if the member isn't the bot's memory for some reason
-        embed.add_field( #adds field with each user to the existing embed
-            name=f"#{i + 1} {display_name}",
-            value=f"Points: {int(user['points'])} | Worksheet Streak: {int(user['streak'])}",
-            inline=False
-        )
+    embeds = group_embeds(build_leaderboard_embeds("🏆 Leaderboard", rows))[0] #the live leaderboard is a single message, so only the top pages that fit are shown
     if config.get('leaderboard_message_id'): #checks if the message_id exists from before to update the message
         try:
             msg = channel.get_partial_message(config['leaderboard_message_id'])
-            await msg.edit(embed=embed)
+            await msg.edit(embeds=embeds)
         except discord.NotFound: #if the message id isn't found (incorrect), it will send it again
-            msg = await channel.send(embed=embed)
+            msg = await channel.send(embeds=embeds)
             config['leaderboard_message_id'] = msg.id
-            db.collection('config').document('settings').set({'leaderboard_message_id': str(msg.id)}, merge=True)
+            await storage.set_config(state.namespace, {'leaderboard_message_id': str(msg.id)})
     else: #sends a new message incase there wasn't an old one on setup or if it was deleted
-        msg = await channel.send(embed=embed)
+        msg = await channel.send(embeds=embeds)
         config['leaderboard_message_id'] = msg.id
-        db.collection('config').document('settings').set({'leaderboard_message_id': str(msg.id)}, merge=True)
+        await storage.set_config(state.namespace, {'leaderboard_message_id': str(msg.id)})
+    state.leaderboard_fingerprint = fingerprint
+    metrics.leaderboard_rebuild_seconds.observe(perf_counter() - start)
+    metrics.leaderboard_users.set(len(state.ranking), state.namespace or "main")
+
+def week_field(day): #name of the user field counting the points of the iso week the day is in, like week_2026_23
+    year, week, _ = day.isocalendar()
+    return f"week_{year}_{week:02d}"
+
+def month_field(day): #same for the month, like month_2026_06
+    return f"month_{day.year}_{day.month:02d}"
+
+def with_periods(changes, day): #adds the weekly and monthly counters to a points change, so the period leaderboards never need a scan
+    points = changes.get('points')
+    if not isinstance(points, Increment):
+        return changes
+    changes = dict(changes)
+    for field in (week_field(day), month_field(day)):
+        if field in (week_field(date.today()), month_field(date.today())): #a replayed award from a period that's already archived only counts towards points
+            changes[field] = Increment(points.value)
+    return changes
+
+async def period_rows(state, field): #(user id, points, streak) rows of a period, straight from its counter field
+    return [(user['id'], user[field], user.get('streak', 0)) for user in await storage.period_scores(state.namespace, field)]
+
+async def archive_period(state, field, rows): #saves a closed period as one snapshot document, then drops its counter from the users
+    await storage.set_history(state.namespace, field, {
+        'period': field,
+        'closed_at': str(date.today()),
+        'users': [str(user_id) for user_id, _, _ in rows], #parallel lists in rank order, firestore doesn't allow lists of lists
+        'points': [int(points) for _, points, _ in rows],
+        'streaks': [int(streak) for _, _, streak in rows]
+    })
+    written, failed = await storage.batch_update(state.namespace, [(user_id, {field: Delete()}) for user_id, _, _ in rows])
+    for user_id, _, _ in rows:
+        state.user_cache.apply(user_id, {field: Delete()})
+    return written, failed
 
-def missed_last_week(date_str): #function to check if 7 days have passed from the input date
+def missed_last_week(date_str, today): #function to check if 7 days have passed from the input date
     record_date = date.fromisoformat(date_str)
-    return (date.today() - record_date).days > 7
+    return (date.fromisoformat(today) - record_date).days > 7
 
 def get_guild(): #function to the get the guild ID, used in slash commands to sync quickly
-    serverID =config.get("server_id")
+    if multi_guild: #commands are synced globally so every server gets them
+        return None
+    serverID = guilds[None].config.get("server_id")
     return discord.Object(id=serverID) if serverID else None
 
-async def log(msg):
-    print(msg)
-    channel_id = config.get("log_channel_id")
-    if not channel_id: #exits the function if log_channel isn't set up yet
-        return
+async def send_log(channel_id, text): #sends one packed log message to a server's log channel, used by the log sink
     logging_channel = bot.get_channel(channel_id)
     if logging_channel: #checks if the channel exists first, to prevent expectation spam
-        try:
-            await logging_channel.send(msg)
-        except Exception as e:
-            print(f"Failed to send log to Discord: {e}")
+        await logging_channel.send(text)
+
+log_sink = LogSink(send_log, log_file, log_queue_size, log_flush_seconds)
+
+class RateLimitCounter(logging.Handler): #discord.py only reports rate limits through its logger, so they are counted from there
+    def emit(self, record):
+        if "rate limit" in record.getMessage():
+            metrics.rate_limit_hits.inc()
+
+rate_limit_counter = RateLimitCounter(level=logging.WARNING) #rate limit messages are warnings, so the debug records skip it cheaply
+logging.getLogger("discord.http").addHandler(rate_limit_counter)
+metrics.queue_depth.callback = lambda: { #read only when /metrics is scraped
+    ("log",): log_sink.depth(),
+    ("journal",): journal.pending_count(),
+    ("storage_waiting",): storage.waiting,
+    ("storage_in_flight",): storage.in_flight,
+    ("leaderboard_pending",): sum(int(state.leaderboard_refresher.dirty) for state in list(guilds.values())),
+    ("user_locks",): sum(len(state.user_locks) for state in list(guilds.values()))
+}
+metrics.gateway_latency.callback = lambda: bot.latency if bot.is_ready() else None
+
+async def log(msg, state=None): #doesn't wait on discord, the sink sends the queued lines to the server's log channel in batches every few seconds
+    print(msg)
+    log_sink.write(msg, state.config.get("log_channel_id") if state else None) #without a server (or a log channel) the line only goes to the log file
 
 @bot.event
 async def on_ready(): # on ready event, essential for the bot, and has the loop checks such as the streaks reset and the monthly and weekly leaderboards
-    print(f"✅ {bot.user} is online")
-    if config["server_id"] is not None:
+    print(f"✅ {bot.user} is online in {len(bot.guilds)} servers")
+    log_sink.start()
+    start_config_watch()
+    flush_journal.start() #also replays anything left unflushed before a restart
+    if multi_guild:
         try:
-            guild = discord.Object(id = config.get("server_id"))
+            synced = await bot.tree.sync() #global commands can take a while to show up, but work in every server
+            print(f"synced {len(synced)} commands globally")
+        except Exception as e:
+            print(f"Error: {e}")
+    elif guilds[None].config["server_id"] is not None:
+        try:
+            guild = discord.Object(id = guilds[None].config.get("server_id"))
             synced = await bot.tree.sync(guild = guild)
-            print(f"synced {len(synced)} commands to {config['server_id']}")
+            print(f"synced {len(synced)} commands to {guilds[None].config['server_id']}")
         except Exception as e:
             print(f"Error: {e}")
     else:
         print("Server ID not set, run .setserver to set the ID")
-    monthly_leaderboard.start()
-    weekly_leaderboard.start()
+    close_periods.start()
     check_streaks.start()
 
+config_watches = [] #the snapshot listeners on every server's settings, started once
+
+def start_config_watch(): #keeps the configs current with snapshot listeners, so changes from the firebase console apply right away
+    if config_watches: #on_ready can run more than once
+        return
+    loop = asyncio.get_running_loop()
+    config_watches.extend(backend.watch_configs(lambda namespace, data: loop.call_soon_threadsafe(apply_config_snapshot, namespace, data), multi_guild)) #one listener for all the servers instead of one each, it runs on another thread
+
+def apply_config_snapshot(namespace, data):
+    state = guilds.get(namespace)
+    if state is None or data is None: #a server this process hasn't loaded (it reads its config when it does), or a deleted document, keep the current config
+        return
+    new_config, _ = parse_config(data)
+    state.config.update(new_config)
+    state.compile_routes()
+
+@bot.event
+async def on_guild_join(guild): #loads (or creates) the new server's config right away
+    await get_state(guild.id)
+
+@bot.event
+async def on_guild_remove(guild): #frees the server's memory, its documents are kept in case the bot is added back
+    if not multi_guild:
+        return
+    guilds.pop(namespace_for(guild.id), None)
+
+@bot.event
+async def on_member_update(before, after): #nickname changes
+    display_names.pop(str(after.id), None)
+
+@bot.event
+async def on_user_update(before, after): #username and global name changes
+    display_names.pop(str(after.id), None)
+
+@bot.event
+async def on_member_remove(member):
+    display_names.pop(str(member.id), None)
+
 # Commands Section
 
 @bot.command() #.setserver sets the server ID in the config, used elsewhere to instantly sync commands.
 @commands.has_permissions(administrator=True)
 async def setserver(ctx):
+    state = await get_state(ctx.guild.id)
     try:
         server_id = str(ctx.guild.id)
-        config_ref = db.collection('config').document('settings')
-        config_ref.set({'server_id': server_id}, merge=True)
-        config["server_id"] = int(server_id)
+        await storage.set_config(state.namespace, {'server_id': server_id})
+        state.config["server_id"] = int(server_id)
         await ctx.author.send(f"✅ Server has been set. Commands will now sync to **{ctx.guild.name}**.")
-        await log(f"✅ Server has been set. Commands will now sync to **{ctx.guild.name}**.")
+        await log(f"✅ Server has been set. Commands will now sync to **{ctx.guild.name}**.", state)
 
     except Exception as e:
         await ctx.author.send("❌ Failed to set server ID.")
-        await log(f"Error setting server ID: {e}")
+        await log(f"Error setting server ID: {e}", state)
 
 @bot.tree.command(name="cfg", description="prints the config", guild=get_guild()) #/cfg prints the config, used mostly for debugging
+@app_commands.guild_only()
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def cfg(interaction):
     try:
-        config_data = db.collection('config').document('settings').get().to_dict()
-        await interaction.response.send_message(config_data, ephemeral=True)
+        state = await get_state(interaction.guild_id)
+        await interaction.response.send_message(state.config, ephemeral=True) #answered from memory, the snapshot listener keeps it current
     except Exception as e:
         print(f"Error: {e}")
 
 @bot.tree.command(name="configure", description="sets the admins and the channels", guild=get_guild()) # sets the settings document in the config collection in the DB
+@app_commands.guild_only()
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def configure(interaction: discord.Interaction, franco_channel: discord.TextChannel, arabic_channel: discord.TextChannel, speaking_channel : discord.TextChannel,
                     dictation_channel :discord.TextChannel, worksheet_channel :discord.TextChannel,leaderboard_channel: discord.TextChannel, weekly_leaderboard: discord.TextChannel ,
                     log_channel: discord.TextChannel, admin1: discord.Member, admin2: discord.Member):
-    if config.get("server_id") is None:
+    state = await get_state(interaction.guild_id)
+    if state.config.get("server_id") is None:
         await interaction.response.send_message("Please set the server ID first by typing .setserver", ephemeral = True)
         return
     try:
-        db.collection('config').document('settings').set({'franco_channel_id' : str(franco_channel.id), 'arabic_channel_id' : str(arabic_channel.id), "speaking_channel_id" : str(speaking_channel.id)
+        await storage.set_config(state.namespace, {'franco_channel_id' : str(franco_channel.id), 'arabic_channel_id' : str(arabic_channel.id), "speaking_channel_id" : str(speaking_channel.id)
                                                              , "dictation_channel_id" : str(dictation_channel.id),"worksheet_channel_id": str(worksheet_channel.id) ,
                                                            'leaderboard_channel_id' : str(leaderboard_channel.id), 'weekly_leaderboard_id':str(weekly_leaderboard.id),
-                                                          'log_channel_id' : str(log_channel.id), 'admin1' : str(admin1.id), 'admin2' : str(admin2.id)},merge=True)
-        config.update(load_config())
+                                                          'log_channel_id' : str(log_channel.id), 'admin1' : str(admin1.id), 'admin2' : str(admin2.id)})
+        state.config.update({'franco_channel_id': franco_channel.id, 'arabic_channel_id': arabic_channel.id, 'speaking_channel_id': speaking_channel.id,
+                             'dictation_channel_id': dictation_channel.id, 'worksheet_channel_id': worksheet_channel.id, 'leaderboard_channel_id': leaderboard_channel.id,
+                             'weekly_leaderboard_id': weekly_leaderboard.id, 'log_channel_id': log_channel.id, 'admin1': admin1.id, 'admin2': admin2.id})
+        state.compile_routes()
         await interaction.response.send_message("config updated successfully", ephemeral = True)
-        await log(f"Server Settings updated successfully by {interaction.user.mention}")
+        await log(f"Server Settings updated successfully by {interaction.user.mention}", state)
+    except Exception as e:
+        print(f"Error: {e}")
+
+
+@bot.tree.command(name="scoring", description="changes a point value or threshold used for scoring", guild=get_guild())
+@app_commands.guild_only()
+@discord.app_commands.checks.has_permissions(administrator=True)
+@app_commands.choices(rule=[Choice(name=key, value=key) for key in default_scoring])
+async def scoring(interaction: discord.Interaction, rule: Choice[str], value: int):
+    try:
+        state = await get_state(interaction.guild_id)
+        state.config["scoring"] = {**state.config["scoring"], rule.value: value}
+        await storage.set_config(state.namespace, {"scoring": state.config["scoring"]})
+        state.compile_routes() #takes effect on the next message, no restart needed
+        await interaction.response.send_message(f"{rule.value} set to {value}", ephemeral=True)
+        await log(f"Scoring rule {rule.value} set to {value} by {interaction.user.mention}", state)
     except Exception as e:
         print(f"Error: {e}")
 
 
 @bot.tree.command(name="leaderboard", description="Tests the leaderboard", guild=get_guild()) #force updates the leaderboard
+@app_commands.guild_only()
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def leaderboard(interaction: discord.Interaction):
-    await update_leaderboard()
-    await interaction.response.send_message(
-        f"Leaderboard successfully updated in <#{config['leaderboard_channel_id']}>", ephemeral=True)
+    await interaction.response.defer(ephemeral=True) #the flush may wait for a running refresh, so defer to not time out the interaction
+    state = await get_state(interaction.guild_id)
+    state.leaderboard_fingerprint = None #forces an edit, in case the message was changed or deleted by hand
+    await state.leaderboard_refresher.flush()
+    stats = state.leaderboard_refresher.stats()
+    await interaction.followup.send(
+        f"Leaderboard successfully updated in <#{state.config['leaderboard_channel_id']}>\n"
+        f"Refreshes requested: {stats['requested']} | Refreshes ran: {stats['ran']}", ephemeral=True)
+
+
+@bot.tree.command(name="rank", description="shows your rank on the leaderboard", guild=get_guild())
+@app_commands.guild_only()
+async def rank(interaction: discord.Interaction, user: discord.User = None):
+    user = user or interaction.user
+    state = await get_state(interaction.guild_id)
+    await load_ranking(state)
+    position = state.ranking.rank(user.id)
+    if position is None:
+        await interaction.response.send_message(f"{user.mention} isn't on the leaderboard yet", ephemeral=True)
+        return
+    await interaction.response.send_message(f"{user.mention} is #{position} out of {len(state.ranking)}", ephemeral=True)
+
+
+@bot.tree.command(name="history", description="shows the leaderboard of a past week or month", guild=get_guild())
+@app_commands.guild_only()
+@app_commands.choices(period=[Choice(name="week", value="week"), Choice(name="month", value="month")])
+async def history(interaction: discord.Interaction, period: Choice[str], ago: app_commands.Range[int, 1, 520] = 1): #discord rejects values outside the range, 520 weeks is ten years back
+    state = await get_state(interaction.guild_id)
+    if period.value == "week":
+        field = week_field(date.today() - timedelta(weeks=ago))
+    else:
+        day = date.today().replace(day=1)
+        for _ in range(ago): #steps back one month at a time
+            day = (day - timedelta(days=1)).replace(day=1)
+        field = month_field(day)
+    snapshot = await storage.get_history(state.namespace, field) #one document read, no matter how many users took part
+    if snapshot is None:
+        await interaction.response.send_message(f"No archived leaderboard for {field}", ephemeral=True)
+        return
+    rows = list(zip(snapshot['users'], snapshot['points'], snapshot['streaks']))
+    embeds = group_embeds(build_leaderboard_embeds(f"🏆 Leaderboard {field}", render_rows(rows)))[0] #only the top pages that fit in one message
+    await interaction.response.send_message(embeds=embeds, ephemeral=True)
+
+
+@bot.tree.command(name="backfill", description="replays the tracked channels' history to award points missed while the bot was down", guild=get_guild())
+@app_commands.guild_only()
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def backfill(interaction: discord.Interaction, start: str, end: str = None):
+    state = await get_state(interaction.guild_id)
+    try:
+        first = date.fromisoformat(start)
+        last = date.fromisoformat(end) if end else date.today()
+    except ValueError:
+        await interaction.response.send_message("Dates have to look like 2026-06-01", ephemeral=True)
+        return
+    #the journal only remembers what was paid for journal_retention_days, and points are reset every month, so older days can't be replayed safely
+    earliest = max(date.today().replace(day=1), date.today() - timedelta(days=journal_retention_days - 1))
+    if first > last or first < earliest or last > date.today():
+        await interaction.response.send_message(f"The range has to be between {earliest} and {date.today()}", ephemeral=True)
+        return
+    if state.backfill_running:
+        await interaction.response.send_message("A backfill is already running", ephemeral=True)
+        return
+    state.backfill_running = True
+    await interaction.response.send_message(f"Backfill from {first} to {last} started, progress is posted in this channel", ephemeral=True)
+    try:
+        scanned, recorded = await run_backfill(state, interaction.channel, first, last)
+        await log(f"Backfill from {first} to {last} ran by {interaction.user.mention}: {scanned} messages scanned, {recorded} awards recorded", state) #the one line the replay sends to the log channel
+    except Exception as e:
+        await log(f"Backfill from {first} to {last} failed: {e}", state)
+    finally:
+        state.backfill_running = False
+
+async def run_backfill(state, report_channel, first, last): #streams each tracked channel's history oldest first through the same scoring as on_message
+    after = datetime.combine(first, time()).astimezone() #local midnights, the same days date.today() uses for live messages
+    before = datetime.combine(last + timedelta(days=1), time()).astimezone()
+    scanned = 0
+    recorded = journal.recorded
+    progress = await report_channel.send(f"⏳ Backfill from {first} to {last}: starting")
+    last_report = perf_counter()
+    for channel_id, (channel_type, score, rules) in list(state.routes.items()):
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            continue
+        async for message in prefetch(channel.history(limit=None, after=after, before=before, oldest_first=True), backfill_prefetch):
+            scanned += 1
+            async with state.user_locks.lock(message.author.id): #same lock as on_message, so live messages and replayed ones don't race
+                await score_message(message, state, score, rules, str(message.created_at.astimezone().date()), quiet=True)
+            if scanned % backfill_batch_size == 0: #the journal is written to the db in batched commits as the replay goes
+                await flush_awards()
+            if perf_counter() - last_report >= backfill_progress_seconds:
+                last_report = perf_counter()
+                await progress.edit(content=f"⏳ Backfill from {first} to {last}: {scanned} messages scanned, in {channel.mention} now, {journal.recorded - recorded} awards recorded")
+    await flush_awards()
+    state.leaderboard_refresher.request()
+    recorded = journal.recorded - recorded
+    await progress.edit(content=f"✅ Backfill from {first} to {last} done: {scanned} messages scanned, {recorded} awards recorded")
+    return scanned, recorded
 
 
 @bot.tree.command(name="add_points", description="adds points to a user", guild=get_guild()) #command for adding points
+@app_commands.guild_only()
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def add_points(interaction: discord.Interaction, user: discord.User, points: int):
-    db.collection('users').document(str(user.id)).update({
-        'points': firestore.Increment(points)
-    })
+    state = await get_state(interaction.guild_id)
+    await admin_change(interaction, state, user.id, with_periods({
+        'points': Increment(points)
+    }, date.today())) #counts towards this week's and this month's leaderboards too
     await interaction.response.send_message(f"{points} points added to {user.mention}", ephemeral=True)
-    await log(f"{points} points added to {user.mention}")
-    await update_leaderboard()
+    await log(f"{points} points added to {user.mention}", state)
+    state.leaderboard_refresher.request()
 
 
 @bot.tree.command(name="remove_points", description="removes points from a user", guild=get_guild()) #command for removing points
+@app_commands.guild_only()
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def remove_points(interaction: discord.Interaction, user: discord.User, points: int):
-    db.collection('users').document(str(user.id)).update({
-        'points': firestore.Increment(-points)
-    })
+    state = await get_state(interaction.guild_id)
+    await admin_change(interaction, state, user.id, with_periods({
+        'points': Increment(-points)
+    }, date.today())) #counts towards this week's and this month's leaderboards too
     await interaction.response.send_message(f"{points} points removed from {user.mention}", ephemeral=True)
-    await log(f"{points} points removed from {user.mention}")
-    await update_leaderboard()
+    await log(f"{points} points removed from {user.mention}", state)
+    state.leaderboard_refresher.request()
 
 @bot.tree.command(name="set_streak", description="sets the streak for a certain user", guild=get_guild())
+@app_commands.guild_only()
 @discord.app_commands.checks.has_permissions(administrator=True)
 async def set_streak(interaction: discord.Interaction, user: discord.Member, streak: int):
+    state = await get_state(interaction.guild_id)
     try:
-        db.collection('users').document(f'{str(user.id)}').set({'streak': streak}, merge=True)
-        await log(f"set streak for {user.mention} to {streak} by {interaction.user.mention}")
+        await admin_change(interaction, state, user.id, {'streak': streak}) #lands after any streak increment still waiting in the journal
+        await log(f"set streak for {user.mention} to {streak} by {interaction.user.mention}", state)
         await interaction.response.send_message(f"set streak for {user.mention} to {streak}", ephemeral=True)
-        await update_leaderboard()
+        state.leaderboard_refresher.request()
     except Exception as e:
-        await log(f"Error setting streak for {user.name}: {e}")
+        await log(f"Error setting streak for {user.name}: {e}", state)
 
 @bot.tree.command(name="reset_date", description="resets a select date for a certain user", guild=get_guild())
+@app_commands.guild_only()
 @discord.app_commands.checks.has_permissions(administrator=True)
 @app_commands.choices(date=[
     Choice(name="Date of the first worksheet sent this week", value="first_worksheet_thisWeek_date"),
     Choice(name="Date of the last worksheet sent", value="last_worksheet_date"),
     Choice(name=f"Date of the last voice note in the speaking channel", value="last_speaking_date"),
-    Choice(name="Date of the last message sent in either writing channel", value="last_writing_date")
+    Choice(name="Date of the last message sent in either writing channel", value="last_writing_date"),
+    Choice(name="Dictation points already earned today", value="dictation")
 ])
 async def reset_date(interaction: discord.Interaction, user: discord.Member, date: Choice[str]):
+    state = await get_state(interaction.guild_id)
     date_to_reset = date.value
-    db.collection('users').document(f'{str(user.id)}').set({f'{date_to_reset}': "2000-01-01"}, merge = True)
+    if date_to_reset != "dictation": #dictation has no date field, only its daily caps
+        await admin_change(interaction, state, user.id, {f'{date_to_reset}': "2000-01-01"}) #a waiting award can't put the old date back
+    release_daily_caps(state, user.id, date_to_reset, interaction.id) #otherwise the journal would still refuse today's award
     await interaction.response.send_message(f"{date.name} was reset for {user.mention}", ephemeral=True)
-    await log(f"{date.name} was reset for {user.mention} by {interaction.user.mention}")
+    await log(f"{date.name} was reset for {user.mention} by {interaction.user.mention}", state)
 
 
 # Event handling part
@@ -284,177 +770,252 @@ async def on_message(message):
     if isinstance(message.channel, discord.Thread): #prevents it from reading messages in threads
         return
 
-    # Check if the message is in a tracked channel
-    tracked_channels = [
-        config.get("franco_channel_id"),
-        config.get("arabic_channel_id"),
-        config.get("speaking_channel_id"),
-        config.get("dictation_channel_id"),
-        config.get("worksheet_channel_id")
-    ]
-    if message.channel.id not in tracked_channels:
+    if message.guild is None: #direct messages only ever carry commands
+        await bot.process_commands(message)
+        return
+
+    state = await get_state(message.guild.id)
+    route = state.routes.get(message.channel.id) #one lookup instead of checking every tracked channel
+    if route is None:
         await bot.process_commands(message)
         return
 
+    channel_type, score, rules = route
+    start = perf_counter()
+    async with state.user_locks.lock(message.author.id): #one message per user at a time, so each daily check sees the award before it, other users aren't held up
+        await score_message(message, state, score, rules)
+    metrics.handler_seconds.observe(perf_counter() - start, channel_type)
+    await bot.process_commands(message) #crucial so the bot can process written commands like .setserver
+
+async def score_message(message, state, score, rules, today=None, quiet=False): #awards the points for a message in one of the tracked channels, today is the message's day and quiet is set when replaying history
     try:
-        user_data = await check_user(message)
+        user_data = await check_user(message, state)
     except Exception as e:
         print(f"check_user error: {e}")
-        await bot.process_commands(message)
         return
 
     if user_data is None:
-        await bot.process_commands(message)
         return
-    # Variables Section
-    effective_streak = min(user_data.get('streak'), 4)
-    text_points = 10
-    voice_points = 15
-    worksheet_points = 20
-    weekly_bonuspercent = 10
-    min_worksheet_length = 100
-    min_dictation_length = 10
-    min_dictation_voice_length = 3
-    min_written_length = 20
-    min_speaking_length = 5
-
-    if message.channel.id == config["franco_channel_id"] or message.channel.id == config["arabic_channel_id"]: #handles messages sent in the franco channel or the arabic channel
-        if user_data.get('last_writing_date') != str(date.today()):
-            if len(message.content) >=min_written_length:
-                await log(f"Valid Message detected in {message.channel.mention} from {message.author.mention}, points awarded: {text_points}")
-                db.collection('users').document(str(message.author.id)).update({
-                    'points': firestore.Increment(text_points),
-                    'last_writing_date': str(date.today())
-                })
-                await update_leaderboard()
-            elif message.attachments:
-                for attachment in message.attachments:
-                    if attachment.content_type and attachment.content_type.startswith("image"):
-                        db.collection('users').document(str(message.author.id)).update({
-                            'points': firestore.Increment(text_points),
-                            'last_writing_date':  str(date.today())
-                        })
-                        await update_leaderboard()
-                        await log(f"Image detected in {message.channel.mention}, points awarded: {text_points}")
-                        break
+    report = None if quiet else state #where the scorers log, a replay only writes to the log file so it doesn't flood the log channel
+    await score(message, state, user_data, rules, today or str(date.today()), report)
+
+async def score_writing(message, state, user_data, rules, today, report): #handles messages sent in the franco channel or the arabic channel
+    text_points = rules["text_points"]
+    if user_data.get('last_writing_date') == today:
+        await log(f"Message Detected in {message.channel.mention} from {message.author.mention}, but they already wrote one today.", report)
+        return
+    if len(message.content) >= rules["min_written_length"]:
+        detected = f"Valid Message detected in {message.channel.mention} from {message.author.mention}"
+    elif any(attachment.content_type and attachment.content_type.startswith("image") for attachment in message.attachments):
+        detected = f"Image detected in {message.channel.mention}"
+    else:
+        return
+    if not await award(message, state, {
+        'points': Increment(text_points),
+        'last_writing_date': today
+    }, "writing", today, daily=True): #the date check passed on stale data, the journal still caught it
+        await log(f"Message Detected in {message.channel.mention} from {message.author.mention}, but they already wrote one today.", report)
+        return
+    await log(f"{detected}, points awarded: {text_points}", report)
+    state.leaderboard_refresher.request()
+
+async def score_speaking(message, state, user_data, rules, today, report):
+    if not message.attachments:
+        return
+    voice_points = rules["voice_points"]
+    min_speaking_length = rules["min_speaking_length"]
+    if user_data.get('last_speaking_date') == today:
+        await log(f"{message.author.mention} sent a message in {message.channel.mention}, but they already sent one today ", report)
+        return
+    for attachment in message.attachments:
+        if attachment.is_voice_message() and attachment.duration >= min_speaking_length: #checks if the user sent a voicenote, and if it is long enough
+            if await award(message, state, {
+                'points': Increment(voice_points),
+                'last_speaking_date': today
+            }, "speaking", today, daily=True):
+                state.leaderboard_refresher.request()
+                await log(f"{message.author.mention} sent a voice message in {message.channel.mention}, points awarded: {voice_points}", report)
+            else:
+                await log(f"{message.author.mention} sent a message in {message.channel.mention}, but they already sent one today ", report)
+            return
         else:
-            await log(f"Message Detected in {message.channel.mention} from {message.author.mention}, but they already wrote one today.")
-    if message.channel.id == config["speaking_channel_id"] and message.attachments:
-        if user_data.get('last_speaking_date') != str(date.today()):
-            for attachment in message.attachments:
-                if attachment.is_voice_message() and attachment.duration >= min_speaking_length: #checks if the user sent a voicenote, and if it is over 5 seconds
-                    db.collection('users').document(str(message.author.id)).update({
-                        'points': firestore.Increment(voice_points),
-                        'last_speaking_date': str(date.today())
-                    })
-                    await update_leaderboard()
-                    await log(f"{message.author.mention} sent a voice message in {message.channel.mention}, points awarded: {voice_points}")
-                else:
-                    await log(f"{message.author.mention} sent a voice message in {message.channel.mention}, but it was shorter than {min_speaking_length}")
+            await log(f"{message.author.mention} sent a voice message in {message.channel.mention}, but it was shorter than {min_speaking_length}", report)
+
+async def score_worksheet(message, state, user_data, rules, today, report):
+    if len(message.content) < rules["min_worksheet_length"]:
+        return
+    worksheet_points = rules["worksheet_points"]
+    effective_streak = min(user_data.get('streak'), rules["max_streak_bonus"])
+    points = int(worksheet_points * (1 + effective_streak * rules["weekly_bonuspercent"]/100))
+    first_date = user_data.get('first_worksheet_thisWeek_date')
+    if missed_last_week(first_date, today):
+        # new window, streak +1
+        if not await award(message, state, {
+            'points': Increment(points),
+            'last_worksheet_date': today,
+            'first_worksheet_thisWeek_date': today,
+            'streak': Increment(1)
+        }, "worksheet", today):
+            return
+        await log(f"{message.author.mention} sent a worksheet answer in {message.channel.mention}, points awarded: {worksheet_points}, streak: increased by 1", report)
+    else:
+        # within window, points with streak bonus but no streak increment
+        if not await award(message, state, {
+            'points': Increment(points),
+            'last_worksheet_date': today,
+        }, "worksheet", today):
+            return
+        await log(f"{message.author.mention} sent a worksheet answer in {message.channel.mention}, points awarded: {worksheet_points}, streak: not increased because their last one was within 7 days ", report)
+    state.leaderboard_refresher.request()
+
+async def score_dictation(message, state, user_data, rules, today, report): #one voice and one text award per day, the journal enforces it since no user field tracks them
+    voice_points = rules["voice_points"]
+    text_points = rules["text_points"]
+    min_dictation_voice_length = rules["min_dictation_voice_length"]
+    min_dictation_length = rules["min_dictation_length"]
+    if message.attachments and message.attachments[0].is_voice_message() and message.attachments[0].duration >= min_dictation_voice_length:
+        if await award(message, state, {
+            'points': Increment(voice_points)
+        }, "dictation_voice", today, daily=True):
+            state.leaderboard_refresher.request()
+            await log(f"{message.author.mention} sent a voice message in {message.channel.mention} with over {min_dictation_voice_length} seconds of duration, points awarded: {voice_points}", report)
         else:
-            await log(f"{message.author.mention} sent a message in {message.channel.mention}, but they already sent one today ")
-    if message.channel.id == config['worksheet_channel_id'] and len(message.content) >= min_worksheet_length:
-        first_date = user_data.get('first_worksheet_thisWeek_date')
-        if missed_last_week(first_date):
-            # new window, streak +1
-            db.collection('users').document(str(message.author.id)).update({
-                'points': firestore.Increment(int(worksheet_points * (1 + effective_streak * weekly_bonuspercent/100))),
-                'last_worksheet_date': str(date.today()),
-                'first_worksheet_thisWeek_date': str(date.today()),
-                'streak': firestore.Increment(1)
-            })
-            await log(f"{message.author.mention} sent a worksheet answer in {message.channel.mention}, points awarded: {worksheet_points}, streak: increased by 1")
+            await log(f"{message.author.mention} sent a voice message in {message.channel.mention}, but they already got dictation voice points today", report)
+    if len(message.content) >= min_dictation_length:
+        if await award(message, state, {
+            'points': Increment(text_points),
+            'last_writing_date': today
+        }, "dictation_text", today, daily=True):
+            state.leaderboard_refresher.request()
+            await log(f"{message.author.mention} sent a text message in {message.channel.mention} with over {min_dictation_length} chars, points awarded: {text_points}", report)
         else:
-            # within window, points with streak bonus but no streak increment
-            db.collection('users').document(str(message.author.id)).update({
-                'points': firestore.Increment(int(worksheet_points * (1 + effective_streak * weekly_bonuspercent/100))),
-                'last_worksheet_date': str(date.today()),
-            })
-            await log(f"{message.author.mention} sent a worksheet answer in {message.channel.mention}, points awarded: {worksheet_points}, streak: not increased because their last one was within 7 days ")
-        await update_leaderboard()
-    if message.channel.id == config['dictation_channel_id']:
-        if message.attachments and message.attachments[0].is_voice_message() and message.attachments[0].duration >= min_dictation_voice_length:
-            db.collection('users').document(str(message.author.id)).update({
-                'points': firestore.Increment(voice_points)
-            })
-            await update_leaderboard()
-            await log(f"{message.author.mention} sent a voice message in {message.channel.mention} with over {min_dictation_voice_length} seconds of duration, points awarded: {voice_points}")
-        if len(message.content) >=min_dictation_length:
-            db.collection('users').document(str(message.author.id)).update({
-                'points': firestore.Increment(text_points),
-                'last_writing_date': str(date.today())
-            })
-            await update_leaderboard()
-            await log(f"{message.author.mention} sent a text message in {message.channel.mention} with over {min_dictation_length} chars, points awarded: {text_points}")
-
-    await bot.process_commands(message) #crucial so the bot can process written commands like .setserver
+            await log(f"{message.author.mention} sent a text message in {message.channel.mention}, but they already got dictation text points today", report)
+
+channel_rules = [ #config key of the channel, channel type used in metrics, scoring function
+    ("franco_channel_id", "writing", score_writing),
+    ("arabic_channel_id", "writing", score_writing),
+    ("speaking_channel_id", "speaking", score_speaking),
+    ("dictation_channel_id", "dictation", score_dictation),
+    ("worksheet_channel_id", "worksheet", score_worksheet)
+]
+
+for guild_state in guilds.values(): #the main server's state is created before the scoring functions exist
+    guild_state.compile_routes()
+
+# Award journal flushing
+@tasks.loop(seconds=journal_flush_seconds)
+async def flush_journal():
+    try:
+        await flush_awards()
+    except Exception as e:
+        print(f"flush_journal error: {e}")
 
-# Monthly Leaderboard Handling
+# Monthly and Weekly Leaderboard Handling
 @tasks.loop(time = time(hour = 0, minute = 0, second = 0))
+async def close_periods(): #one task for both, so on a monday that's the 1st the month and the week close one after the other instead of racing
+    for attempt in range(period_close_retries + 1):
+        if attempt:
+            await asyncio.sleep(period_close_retry_seconds)
+        if await monthly_leaderboard() and await weekly_leaderboard(): #a period that's already archived is skipped, so a retry only does what's left
+            return
+    print(f"Closing the periods failed {period_close_retries + 1} times, the award journal couldn't be flushed")
+
 #@bot.tree.command(name="monthly_leaderboard", description="Tests the monthly leaderboard", guild=get_guild())
-async def monthly_leaderboard():
+async def monthly_leaderboard(): #returns False if the month couldn't be closed yet
     if date.today().day != 1:
+        return True
+    async with flush_lock: #held until the points are reset, so the flush loop can't write awards between the read and the reset
+        if not await flush_locked(): #pending awards must land before the counters are read, or they'd land after the archive and the reset
+            print("Monthly close postponed, the award journal couldn't be flushed")
+            return False
+        await for_each_guild(close_month)
+    return True
+
+async def close_month(state):
+    if state.config.get("weekly_leaderboard_id") is None: #server isn't configured yet
+        return
+    closed = date.today() - timedelta(days=1) #the month that just ended
+    field = month_field(closed)
+    if await storage.get_history(state.namespace, field) is not None: #closed by an earlier try
         return
-    user_data = db.collection('users').get()
-    docs = [{ 'id': doc.id, **doc.to_dict()} for doc in user_data]
-    sorted_data = sorted(docs, key=lambda x: x['points'], reverse=True)
-    channel = bot.get_channel(config["weekly_leaderboard_id"])
-    embed = discord.Embed(title=f"🏆 {date.today().strftime('%B')} Leaderboard", color=discord.Color.gold())
-    embed.set_thumbnail(url="https://i.ibb.co/BKLCTWv5/4ab2bbcfa5b9a10891406d2a84e94004.webp")
-    embed.timestamp = discord.utils.utcnow()
-
-    for i, user in enumerate(sorted_data):
-        member =  bot.get_user(int(user['id']))
-        display_name = member.display_name if member else "Unknown User"  # fallback if the member isn't the bot's memory for some reason
-        embed.add_field(
-            name=f"#{i + 1} {display_name}",
-            value=f"Points: {int(user['points'])} | Worksheet Streak: {int(user['streak'])}",
-            inline=False
-        )
-    await channel.send(embed=embed)
-    winner = await bot.fetch_user(int(sorted_data[0]['id']))
-    await channel.send(f"🎉 Congratulations {winner.mention}! You won this month! Please open a ticket or message us on WhatsApp.")
-    all_users = db.collection('users').get()
-    for user in all_users:
-        db.collection('users').document(user.id).update({'points': 0})
+    rows = await period_rows(state, field)
+    channel = bot.get_channel(state.config["weekly_leaderboard_id"])
+    await send_leaderboard(channel, f"🏆 {closed.strftime('%B')} Leaderboard", rows)
+    if rows:
+        winner_id = rows[0][0] #a mention only needs the id, so there is no need to fetch the user
+        await channel.send(f"🎉 Congratulations <@{winner_id}>! You won this month! Please open a ticket or message us on WhatsApp.")
+    await archive_period(state, field, rows)
+    await load_ranking(state)
+    kept = {str(user['id']): user[month_field(date.today())] for user in await storage.period_scores(state.namespace, month_field(date.today()))} #points earned since midnight were flushed with last month's, they stay
+    written, failed = await storage.batch_update(state.namespace, [(user_id, {'points': kept.get(user_id, 0)}) for user_id in state.ranking.user_ids()])
+    state.ranking.reset_points(kept)
+    for _, namespace, user_id, changes in journal.pending(-1): #awards recorded during the close are written after the reset
+        if namespace == state.namespace and 'points' in changes:
+            state.ranking.apply(user_id, {'points': changes['points']})
+    state.user_cache.clear()
     # await interaction.response.send_message("test", ephemeral=True)
-    await log(f"Monthly leaderboard for {date.today().strftime('%B')} sent, and all the points are reset! ")
+    await log(f"Monthly leaderboard for {closed.strftime('%B')} sent and archived, and the points of {written} users are reset! Failed resets: {failed}", state)
 # Weekly Leaderboard Handling
-@tasks.loop(time= time(hour = 0, minute = 0, second = 0))
 #@bot.tree.command(name="weekly_leaderboard", description="Tests the weekly leaderboard", guild=get_guild())
-async def weekly_leaderboard():
-    if date.today().weekday() != 0 or date.today().day == 1:
+async def weekly_leaderboard(): #returns False if the week couldn't be closed yet
+    if date.today().weekday() != 0:
+        return True
+    async with flush_lock: #held until the counters are archived, so a late award from last week can't recreate the counter after it's dropped
+        if not await flush_locked():
+            print("Weekly close postponed, the award journal couldn't be flushed")
+            return False
+        await for_each_guild(close_week)
+    return True
+
+async def close_week(state):
+    if state.config.get("weekly_leaderboard_id") is None: #server isn't configured yet
+        return
+    field = week_field(date.today() - timedelta(days=1)) #the week that ended yesterday
+    if await storage.get_history(state.namespace, field) is not None: #closed by an earlier try
         return
-    user_data = db.collection('users').get()
-    docs = [{'id': doc.id, **doc.to_dict()} for doc in user_data]
-    sorted_data = sorted(docs, key=lambda x: x['points'], reverse=True)
-    channel = bot.get_channel(config["weekly_leaderboard_id"])
-    embed = discord.Embed(title=f"🏆 Weekly Leaderboard", color=discord.Color.gold())
-    embed.set_thumbnail(url="https://i.ibb.co/BKLCTWv5/4ab2bbcfa5b9a10891406d2a84e94004.webp")
-    embed.timestamp = discord.utils.utcnow()
-    for i, user in enumerate(sorted_data):
-        member =  bot.get_user(int(user['id']))
-        display_name = member.display_name if member else "Unknown User"  # fallback if the member isn't the bot's memory for some reason
-        embed.add_field(
-            name=f"#{i + 1} {display_name}",
-            value=f"Points: {int(user['points'])} | Worksheet Streak: {int(user['streak'])}",
-            inline=False
-        )
-    await channel.send(embed=embed)
-    await log(f"Weekly Leaderboard sent")
+    rows = await period_rows(state, field)
+    if date.today().day != 1: #the monthly leaderboard is posted instead on the 1st, the week is still archived
+        channel = bot.get_channel(state.config["weekly_leaderboard_id"])
+        await send_leaderboard(channel, "🏆 Weekly Leaderboard", rows)
+    await archive_period(state, field, rows)
+    await log(f"Weekly Leaderboard for {len(rows)} users sent and archived", state)
 
 # daily check streaks
 @tasks.loop(time=time(hour=0, minute=0, second=0))
 # @bot.tree.command(name="check_streaks", description="checks the streaks and resets if they haven't posted within a week", guild=get_guild())
 async def check_streaks():
-    all_users = db.collection('users').get()
-    for user in all_users:
-        user_data = user.to_dict()
-        if missed_last_week(user_data.get('last_worksheet_date')) and user_data.get('streak', 0) > 0: #zero in the bracket is the fallback value
-            db.collection('users').document(user.id).update({'streak': 0})
-            await log(f"Reset streak for <@{user.id}>")
+    if not await flush_awards(): #the query reads the db, so waiting worksheet awards must land first or their streak increments would be reset on top of a stale streak
+        print("Streak check skipped, the award journal couldn't be flushed, the next run catches up")
+        return
+    await for_each_guild(reset_streaks)
+
+async def reset_streaks(state):
+    cutoff = str(date.today() - timedelta(days=7)) #iso dates compare correctly as strings, same rule as missed_last_week
+    expired = [] #only the ids are kept, so memory depends on the number of expiring streaks
+    written = 0
+    failed = 0
+    cursor = None
+    while True: #pages through the results with cursors instead of downloading every user, the firestore query needs the index in firestore.indexes.json
+        page, cursor = await storage.expiring_streaks(state.namespace, cutoff, streak_page_size, cursor)
+        if not page:
+            break
+        page_written, page_failed = await storage.batch_update(state.namespace, [(user['id'], {'streak': 0}) for user in page])
+        written += page_written
+        failed += page_failed
+        for user in page:
+            state.user_cache.invalidate(user['id'])
+            state.ranking.apply(user['id'], {'streak': 0})
+            expired.append(user['id'])
+        if len(page) < streak_page_size:
+            break
+    if not expired:
+        return
+    mentions = " ".join(f"<@{user_id}>" for user_id in expired[:50]) #caps the mentions so the summary fits in one discord message
+    more = f" and {len(expired) - 50} more" if len(expired) > 50 else ""
+    await log(f"Reset streak for {written} users, failed: {failed}\n{mentions}{more}", state)
 
 
 
-webserver.keep_alive()
-bot.run(token, log_handler=handler, log_level=logging.DEBUG)
+if __name__ == "__main__": #lets bench.py import the bot without starting it
+    webserver.keep_alive()
+    bot.run(token, log_handler=handler, log_level=logging.DEBUG)
@@ -0,0 +1,104 @@
+from bisect import bisect_left
+
+# Prometheus style metrics, served as text by the /metrics route in webserver.py
+# Recording is a dict update, the text is only built when someone scrapes, and gauges are read through callbacks at scrape time
+
+registry = []
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in list(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Gauge:
+    def __init__(self, name, help_text, labels=(), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.callback = callback # returns {label values tuple: value}, or a single number for an unlabeled gauge
+        self.values = {}
+        registry.append(self)
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def render(self):
+        values = self.values
+        if self.callback is not None:
+            try:
+                result = self.callback()
+            except Exception: # a broken callback shouldn't break the whole scrape
+                result = {}
+            values = result if isinstance(result, dict) else {(): result}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for label_values, value in list(values.items()):
+            if value is None:
+                continue
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = list(buckets)
+        self.values = {} # label values -> [count per bucket + one for +Inf, sum, count]
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1 # only the matching bucket, they are made cumulative when rendered
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+def render(): # the text exposition format that prometheus scrapes
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Metrics recorded by the bot
+handler_seconds = Histogram("bot_handler_seconds", "on_message handling time by channel type", ("channel",))
+storage_ops = Counter("bot_storage_operations_total", "storage operations by collection and operation", ("collection", "operation"))
+leaderboard_rebuild_seconds = Histogram("bot_leaderboard_rebuild_seconds", "live leaderboard rebuild time")
+leaderboard_unchanged = Counter("bot_leaderboard_unchanged_total", "live leaderboard refreshes skipped because nothing visible changed")
+leaderboard_users = Gauge("bot_leaderboard_users", "number of users on the leaderboard at the last rebuild", ("guild",))
+rate_limit_hits = Counter("bot_discord_rate_limits_total", "discord rate limit warnings logged by discord.py")
+user_cache_lookups = Counter("bot_user_cache_lookups_total", "check_user cache lookups by result, the hit rate is hit / (hit + miss)", ("result",))
+log_lines_dropped = Counter("bot_log_lines_dropped_total", "log lines that only went to the log file because the log queue was full")
+log_messages_sent = Counter("bot_log_messages_sent_total", "packed log messages sent to discord")
+queue_depth = Gauge("bot_queue_depth", "items waiting in the bot's queues", ("queue",))
+gateway_latency = Gauge("bot_gateway_latency_seconds", "discord gateway heartbeat latency")
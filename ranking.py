@@ -0,0 +1,68 @@
+from bisect import bisect_left, insort
+from backends import Increment
+
+class Ranking: # users kept sorted by points, updated on every point change instead of sorting the whole collection
+    def __init__(self):
+        self.loaded = False
+        self._users = {} # user id -> {'points': .., 'streak': ..}
+        self._order = [] # sorted list of (-points, user id), so the first item is the top user
+
+    def load(self, docs): # builds the index from a full scan, docs are dicts with an 'id' key
+        self._users = {}
+        for doc in docs:
+            self._users[str(doc['id'])] = {'points': int(doc.get('points', 0)), 'streak': int(doc.get('streak', 0))}
+        self._order = sorted((-user['points'], user_id) for user_id, user in self._users.items())
+        self.loaded = True
+
+    def apply(self, user_id, changes): # mirrors an update() on the user's document, increments included
+        if not self.loaded:
+            return
+        user_id = str(user_id)
+        user = self._users.get(user_id)
+        if user is None: # first points for a new user
+            user = {'points': 0, 'streak': 0}
+        else:
+            self._remove(user_id, user)
+        for key in ('points', 'streak'):
+            if key not in changes:
+                continue
+            value = changes[key]
+            if isinstance(value, Increment):
+                user[key] = user[key] + value.value
+            else:
+                user[key] = int(value)
+        self._users[user_id] = user
+        insort(self._order, (-user['points'], user_id))
+
+    def reset_points(self, kept=None): # used by the monthly reset, kept maps user ids to the points they keep
+        kept = kept or {}
+        for user_id, user in self._users.items():
+            user['points'] = int(kept.get(user_id, 0))
+        self._order = sorted((-user['points'], user_id) for user_id, user in self._users.items())
+
+    def rank(self, user_id): # 1 based rank of the user, None if the user isn't ranked
+        user = self._users.get(str(user_id))
+        if user is None:
+            return None
+        return bisect_left(self._order, (-user['points'], str(user_id))) + 1
+
+    def page(self, start, count): # returns [(user id, points, streak)] for the ranks start+1 .. start+count
+        rows = []
+        for _, user_id in self._order[start:start + count]:
+            user = self._users[user_id]
+            rows.append((user_id, user['points'], user['streak']))
+        return rows
+
+    def top(self, count):
+        return self.page(0, count)
+
+    def user_ids(self):
+        return list(self._users)
+
+    def _remove(self, user_id, user):
+        index = bisect_left(self._order, (-user['points'], user_id))
+        if index < len(self._order) and self._order[index][1] == user_id:
+            del self._order[index]
+
+    def __len__(self):
+        return len(self._order)
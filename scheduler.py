@@ -0,0 +1,47 @@
+import asyncio
+
+class RefreshScheduler: # coalesces refresh requests so the wrapped coroutine runs at most once per window
+    def __init__(self, refresh, window):
+        self.refresh = refresh # async function that does the actual rebuild
+        self.window = window # minimum number of seconds between two runs
+        self.dirty = False
+        self.requested = 0 # how many times a refresh was asked for
+        self.ran = 0 # how many times the refresh actually ran
+        self._last_run = None
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def request(self): # marks the leaderboard dirty, and schedules a run if one isn't already pending
+        self.requested += 1
+        self.dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run_later())
+
+    async def flush(self): # force flush, runs the refresh right away ignoring the window
+        self.requested += 1
+        self.dirty = True
+        await self._run()
+
+    def stats(self):
+        return {"requested": self.requested, "ran": self.ran, "pending": self.dirty}
+
+    async def _run_later(self):
+        loop = asyncio.get_running_loop()
+        while self.dirty: # loops in case a new request came in while the last refresh was running
+            if self._last_run is not None:
+                delay = self._last_run + self.window - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self._run()
+
+    async def _run(self):
+        async with self._lock: # only one refresh at a time, a flush waits for a running refresh
+            if not self.dirty: # another run already picked the requests up
+                return
+            self.dirty = False
+            self._last_run = asyncio.get_running_loop().time()
+            self.ran += 1
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Leaderboard refresh failed: {e}")
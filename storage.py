@@ -0,0 +1,95 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+class Storage: # async access to a storage backend, blocking backends run on a bounded thread pool so they don't stall the event loop
+    def __init__(self, backend, max_workers, max_concurrency, timeout, scan_timeout):
+        self.backend = backend
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency # max number of calls in flight, extra calls wait their turn
+        self.timeout = timeout # default per call timeout in seconds
+        self.scan_timeout = scan_timeout # longer timeout for reading the whole users collection
+        self.in_flight = 0
+        self.waiting = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(self, func, *args, timeout=None, **kwargs): # usage: await storage.run(backend.get_user, namespace, user_id)
+        if not self.backend.blocking: # in memory backends answer right away
+            return func(*args, **kwargs)
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            call = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+            if timeout == 0: # no deadline, the caller can't safely retry while the thread may still be writing
+                return await call
+            return await asyncio.wait_for(call, timeout or self.timeout) # raises asyncio.TimeoutError if the backend is too slow
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    async def get_user(self, namespace, user_id):
+        metrics.storage_ops.inc('users', 'get')
+        return await self.run(self.backend.get_user, namespace, user_id)
+
+    async def set_user(self, namespace, user_id, data, merge=False):
+        metrics.storage_ops.inc('users', 'set')
+        await self.run(self.backend.set_user, namespace, user_id, data, merge=merge)
+
+    async def scan_users(self, namespace):
+        metrics.storage_ops.inc('users', 'scan')
+        return await self.run(self.backend.scan_users, namespace, timeout=self.scan_timeout)
+
+    async def expiring_streaks(self, namespace, cutoff, page_size, cursor=None):
+        metrics.storage_ops.inc('users', 'query')
+        return await self.run(self.backend.expiring_streaks, namespace, cutoff, page_size, cursor)
+
+    async def period_scores(self, namespace, field):
+        metrics.storage_ops.inc('users', 'query')
+        return await self.run(self.backend.period_scores, namespace, field, timeout=self.scan_timeout)
+
+    async def get_history(self, namespace, period):
+        metrics.storage_ops.inc('history', 'get')
+        return await self.run(self.backend.get_history, namespace, period)
+
+    async def set_history(self, namespace, period, data):
+        metrics.storage_ops.inc('history', 'set')
+        await self.run(self.backend.set_history, namespace, period, data)
+
+    async def set_config(self, namespace, data, merge=True):
+        metrics.storage_ops.inc('config', 'set')
+        await self.run(self.backend.set_config, namespace, data, merge=merge)
+
+    async def flush_batch(self, namespace, writes, marker): # one batch of journaled awards with its marker, waits for the commit instead of timing out so it's never written twice
+        metrics.storage_ops.inc('users', 'batch_write')
+        await self.run(self.backend.write_users, namespace, writes, merge=True, marker=marker, timeout=0)
+
+    async def last_flush(self, journal_id):
+        metrics.storage_ops.inc('flushes', 'get')
+        return await self.run(self.backend.last_flush, journal_id)
+
+    async def batch_update(self, namespace, updates, chunk_size=500, retries=3, merge=False): # writes a list of (user id, changes) as chunked batches, returns how many were written and how many failed
+        # retried chunks may be written twice, so only use it for absolute values, increments go through flush_batch
+        written = 0
+        failed = 0
+        for start in range(0, len(updates), chunk_size): # firestore allows at most 500 operations per batch
+            chunk = updates[start:start + chunk_size]
+            for attempt in range(retries):
+                try:
+                    metrics.storage_ops.inc('users', 'batch_write')
+                    await self.run(self.backend.write_users, namespace, chunk, merge=merge)
+                    written += len(chunk)
+                    break
+                except Exception as e:
+                    print(f"Batch write failed (attempt {attempt + 1}/{retries}): {e}")
+                    if attempt + 1 < retries:
+                        await asyncio.sleep(2 ** attempt) # backs off before retrying the same chunk
+            else:
+                failed += len(chunk)
+        return written, failed
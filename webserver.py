@@ -1,14 +1,19 @@
-from flask import Flask
+from flask import Flask, Response
 from threading import Thread
+import metrics
 
 app = Flask("")
 @app.route("/")
 def home():
     return "discord bot good!"
 
+@app.route("/metrics")
+def metrics_page(): #prometheus scrapes this, the text is only built when it's requested
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 def run():
     app.run(host="0.0.0.0", port=8080)
 
 def keep_alive():
     t = Thread(target=run)
-    t.start()
\ No newline at end of file
+    t.start()